@@ -0,0 +1,79 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+"""Count CouchDB round trips per batch with and without bulk fetching.
+
+Runs UpdateAnnouncer.update_index against a local fake CouchDB with the
+AMQP channel replaced by a stub, once per bulk_fetch setting.
+
+Usage: python bench/bench_bulk_fetch.py [DOCS] [BATCH_SIZE]
+"""
+
+import os, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from couchdbsolr2.announcer import UpdateAnnouncer
+from fakecouch import FakeCouchDB
+
+
+class StubChannel(object):
+
+    def __init__(self):
+        self.published = 0
+
+    def basic_publish(self, msg, routing_key):
+        self.published += 1
+
+
+def make_docs(count):
+    for i in xrange(count):
+        yield {'_id' : 'doc%06d' % i, 'type' : 'Post',
+               'payload' : {'title' : 'Post %d' % i, 'tags' : ['a', 'b']},
+               'timesaved' : i, 'solr_fields' : ['payload', 'timesaved']}
+
+
+def run(couch, batch_size, bulk_fetch):
+    fd, seqid_file = tempfile.mkstemp()
+    os.close(fd)
+    os.unlink(seqid_file)
+    try:
+        announcer = UpdateAnnouncer({'routing_key' : 'x'}, couch.uri,
+                                    seqid_file, batch_size=batch_size,
+                                    bulk_fetch=bulk_fetch)
+        announcer.channel = StubChannel()
+        couch.reset()
+        start = time.time()
+        announcer.update_index('bench')
+        return couch.requests, time.time() - start
+    finally:
+        if os.path.exists(seqid_file):
+            os.unlink(seqid_file)
+
+
+def main():
+    docs = len(sys.argv) > 1 and int(sys.argv[1]) or 5000
+    batch_size = len(sys.argv) > 2 and int(sys.argv[2]) or 1000
+    batches = (docs + batch_size - 1) // batch_size
+
+    couch = FakeCouchDB().start()
+    couch.add_docs('bench', make_docs(docs))
+    print "%d documents, batch_size=%d (%d batches)" % (docs, batch_size, batches)
+    print "%-12s %10s %14s %10s" % ('bulk_fetch', 'requests', 'per batch', 'seconds')
+    for bulk_fetch in (0, 100, 1000):
+        requests, elapsed = run(couch, batch_size, bulk_fetch)
+        total = sum(requests.values())
+        print "%-12d %10d %14.1f %10.2f" % (bulk_fetch, total,
+                                            float(total) / batches, elapsed)
+    couch.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
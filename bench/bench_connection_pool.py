@@ -0,0 +1,64 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+"""Count TCP connections opened to Solr per batch of updates.
+
+Sends updates from several threads to a local fake Solr, first with a
+new SolrConnection per update (as SolrUpdater used to), then through one
+shared ConnectionPool.
+
+Usage: python bench/bench_connection_pool.py [UPDATES] [THREADS]
+"""
+
+import os, sys, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from couchdbsolr2.solr import ConnectionPool, SolrConnection
+from fakesolr import FakeSolr
+
+
+def run(solr, updates, threads, pool_factory):
+    """Send updates from threads; pool_factory is called once per update."""
+    per_thread = updates // threads
+
+    def send(n):
+        for i in xrange(per_thread):
+            conn = SolrConnection(solr.uri, pool=pool_factory())
+            conn.add(id='doc%d-%d' % (n, i), title='Update %d' % i)
+
+    workers = [threading.Thread(target=send, args=(n,)) for n in xrange(threads)]
+    solr.reset()
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return solr.stats, time.time() - start
+
+
+def main():
+    updates = len(sys.argv) > 1 and int(sys.argv[1]) or 10000
+    threads = len(sys.argv) > 2 and int(sys.argv[2]) or 10
+
+    solr = FakeSolr().start()
+    shared = ConnectionPool(threads)
+    print "%d updates from %d threads" % (updates, threads)
+    print "%-22s %12s %10s %10s" % ('mode', 'connections', 'requests', 'seconds')
+    for mode, factory in (('connection per update', lambda: None),
+                          ('shared pool', lambda: shared)):
+        stats, elapsed = run(solr, updates, threads, factory)
+        print "%-22s %12d %10d %10.2f" % (mode, stats.get('connections', 0),
+                                          stats.get('requests', 0), elapsed)
+    solr.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,42 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+"""Time the iterative flattener against the recursive one it replaced.
+
+tests/test_flatten.py checks that both produce the same fields.
+
+Usage: python bench/bench_flatten.py [DOCS] [ROUNDS]
+"""
+
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from couchdbsolr2.flatten import flatten
+from tests.test_flatten import FIELDS, make_docs, recursive
+
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 1000
+    rounds = len(sys.argv) > 2 and int(sys.argv[2]) or 5
+    docs = make_docs(count)
+    fields = FIELDS
+
+    print "%-10s %12s" % ('flattener', 'ms/round')
+    for name, run in (('recursive', recursive), ('iterative', flatten)):
+        start = time.time()
+        for i in xrange(rounds):
+            for doc in docs:
+                run(doc, fields)
+        print "%-10s %12.1f" % (name, (time.time() - start) * 1000 / rounds)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+"""Time answering queued search requests against a slow fake Solr.
+
+Every request takes FAST seconds in Solr, except every tenth which takes
+SLOW seconds. Requests are handled one after another as
+couchdb-solr2-query used to, then with serve_concurrently at increasing
+concurrency, checking that responses still come out in request order.
+
+Usage: python bench/bench_query.py [REQUESTS] [FAST] [SLOW]
+"""
+
+import cgi, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from couchdbsolr2.query import handle_request, serve_concurrently
+from couchdbsolr2.solr import ConnectionPool, SolrConnection
+from fakesolr import FakeSolr
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+class Recorder(object):
+    """Stands in for LineProtocol, keeping what would go to stdout."""
+
+    def __init__(self):
+        self.lines = []
+
+    def output(self, out, serialize=False):
+        self.lines.append(out)
+
+
+def make_requests(count):
+    return [{'db' : 'bench', 'query' : {'q' : i % 10 and 'fast' or 'slow',
+                                        'offset' : i}}
+            for i in xrange(count)]
+
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 200
+    fast = len(sys.argv) > 2 and float(sys.argv[2]) or 0.01
+    slow = len(sys.argv) > 3 and float(sys.argv[3]) or 0.2
+
+    solr = FakeSolr(delay=lambda body: 'slow' in body and slow or fast).start()
+    # Echo the requested offset so the order of responses can be checked
+    solr.select_response = lambda body: '{"response":{"numFound":0,' \
+        '"start":%s,"docs":[]}}' % cgi.parse_qs(body)['start'][0]
+
+    print "%d requests, %.3fs each, every tenth %.3fs" % (count, fast, slow)
+    print "%-12s %10s %12s" % ('concurrency', 'seconds', 'requests/s')
+    for concurrency in (1, 2, 4, 8, 16):
+        conn = SolrConnection(solr.uri, pool=ConnectionPool(concurrency))
+        handle = lambda request: handle_request(request, conn)
+        protocol = Recorder()
+        requests = make_requests(count)
+        start = time.time()
+        if concurrency == 1:
+            for request in requests:
+                protocol.output(handle(request))
+        else:
+            serve_concurrently(iter(requests), handle, protocol, concurrency)
+        elapsed = time.time() - start
+        starts = [json.loads(line)['json']['start'] for line in protocol.lines]
+        assert starts == range(count), "Responses out of order"
+        print "%-12d %10.2f %12.1f" % (concurrency, elapsed, count / elapsed)
+    solr.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+"""Compare decoding and re-encoding Solr responses with splicing them.
+
+Builds synthetic Solr JSON responses with stored fields of various sizes
+and checks that the spliced response decodes to the same value as the
+decoded and re-encoded one before timing both.
+
+Usage: python bench/bench_query_response.py [ROUNDS]
+"""
+
+import os, random, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from couchdbsolr2.query import raw_members
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+SHAPES = [
+    # (documents, fields, characters per field, alphabet)
+    (25, 10, 20, u'abcdefghij      é'),
+    (25, 10, 2000, u'abcdefghij      é'),
+    (100, 30, 50, u'abcdefghij      é'),
+    (25, 10, 2000, u'abcdefghij    é"\\{['),
+]
+
+
+def make_response(rand, count, fields, length, alphabet):
+    docs = [dict(('post/field%d' % f,
+                  u''.join([rand.choice(alphabet) for i in xrange(length)]))
+                 for f in xrange(fields))
+            for d in xrange(count)]
+    return json.dumps({
+        'responseHeader' : {'status' : 0, 'QTime' : 3,
+                            'params' : {'q' : '_db:bench AND post'}},
+        'response' : {'numFound' : 1000, 'start' : 0, 'docs' : docs},
+        'highlighting' : {'doc1' : {'post/field0' : ['<em>post</em>']}}
+    }, ensure_ascii=False).encode('utf-8')
+
+
+def decoded(text):
+    return json.dumps({'code' : 200, 'json' : json.loads(text)['response']})
+
+
+def spliced(text):
+    return '{"code": 200, "json": %s}' % raw_members(text)['response']
+
+
+def main():
+    rounds = len(sys.argv) > 1 and int(sys.argv[1]) or 50
+    rand = random.Random(42)
+
+    print "%-22s %10s %12s %12s" % ('docs x fields x chars', 'bytes',
+                                    'decode ms', 'splice ms')
+    for count, fields, length, alphabet in SHAPES:
+        text = make_response(rand, count, fields, length, alphabet)
+        assert json.loads(spliced(text)) == json.loads(decoded(text)), \
+            "Spliced response differs"
+        times = []
+        for run in (decoded, spliced):
+            start = time.time()
+            for i in xrange(rounds):
+                run(text)
+            times.append((time.time() - start) * 1000 / rounds)
+        shape = '%d x %d x %d%s' % (count, fields, length,
+                                    '"' in alphabet and ' esc' or '')
+        print "%-22s %10d %12.2f %12.2f" % (shape, len(text), times[0],
+                                            times[1])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+"""Compare building Solr add requests with ElementTree against streaming.
+
+The ElementTree path is the one SolrUpdater used to take: a SubElement
+per field holding escapeKey/escapeVal output, serialized twice (once for
+the debug log). Reports time per message and the largest string held in
+memory at once.
+
+Usage: python bench/bench_serialize.py [DOCS] [FIELDS] [ROUNDS]
+"""
+
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from couchdbsolr2.serialize import json_add_chunks, xml_add_chunks
+from couchdbsolr2.solr import SolrConnection
+
+try:
+    import cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+
+def make_docs(count, fields):
+    docs = []
+    for i in xrange(count):
+        doc = [('post/field%d' % f, u'Value %d of <doc> %d & more text' % (f, i))
+               for f in xrange(fields)]
+        doc.extend([('type', 'any'), ('_id', 'doc%d' % i), ('_db', 'bench')])
+        docs.append(doc)
+    return docs
+
+
+def elementtree(docs):
+    solr = SolrConnection()
+    add = ET.Element('add')
+    for update in docs:
+        doc = ET.SubElement(add, 'doc')
+        for k, v in update:
+            field = ET.SubElement(doc, 'field')
+            field.attrib['name'] = solr.escapeKey(k)
+            field.text = solr.escapeVal(v)
+    debug = ET.tostring(add)
+    body = ET.tostring(add)
+    return len(body)
+
+
+def streaming(serializer):
+    def run(docs):
+        largest = 0
+        for chunk in serializer(docs):
+            largest = max(largest, len(chunk))
+        return largest
+    return run
+
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 1000
+    fields = len(sys.argv) > 2 and int(sys.argv[2]) or 20
+    rounds = len(sys.argv) > 3 and int(sys.argv[3]) or 10
+    docs = make_docs(count, fields)
+
+    print "%d documents of %d fields, %d rounds" % (count, fields, rounds)
+    print "%-14s %14s %18s" % ('serializer', 'ms/message', 'largest string')
+    for name, run in (('elementtree', elementtree),
+                      ('streaming xml', streaming(xml_add_chunks)),
+                      ('streaming json', streaming(json_add_chunks))):
+        start = time.time()
+        for i in xrange(rounds):
+            largest = run(docs)
+        elapsed = (time.time() - start) / rounds
+        print "%-14s %14.1f %18d" % (name, elapsed * 1000, largest)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
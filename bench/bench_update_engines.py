@@ -0,0 +1,115 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+"""Compare the throughput of the threaded and async updater engines.
+
+Feeds the same update messages to SolrUpdater and AsyncSolrUpdater from
+a fake AMQP channel, against a local fake Solr answering every request
+after DELAY milliseconds, and times each engine until it has applied all
+of them.
+
+Usage: python bench/bench_update_engines.py [MESSAGES] [DOCS] [DELAY]
+           [WORKERS] [IN_FLIGHT]
+"""
+
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from couchdbsolr2.asyncupdater import AsyncSolrUpdater
+from couchdbsolr2.message import encode
+from couchdbsolr2.updater import SolrUpdater
+from fakesolr import FakeSolr
+
+
+class Message(object):
+
+    def __init__(self, body, properties, tag):
+        self.body = body
+        self.properties = properties
+        self.delivery_info = {'delivery_tag' : tag}
+
+
+class Channel(object):
+    """Delivers messages from a list, then stops the updater."""
+
+    def __init__(self, updater, messages):
+        self.updater = updater
+        self.messages = messages
+        self.acks = 0
+
+    def basic_consume(self, queue, callback, no_ack):
+        self.callback = callback
+
+    def wait(self):
+        if self.messages:
+            self.callback(self.messages.pop())
+        else:
+            self.updater.stop()
+
+    def basic_ack(self, tag):
+        self.acks += 1
+
+    def basic_reject(self, tag, requeue):
+        pass
+
+    def close(self):
+        pass
+
+
+def make_messages(count, docs):
+    messages = []
+    for i in xrange(count):
+        data = [[('title', u'Document %d of message %d' % (d, i)),
+                 ('body', u'Some text ' * 20), ('type', 'any'),
+                 ('_id', 'doc%d-%d' % (i, d)), ('_db', 'bench')]
+                for d in xrange(docs)]
+        body, properties = encode({'type' : 'updated', 'data' : data})
+        messages.append(Message(body, properties, i))
+    messages.reverse()
+    return messages
+
+
+def run(updater, messages, workers):
+    updater.channel = updater.conn = Channel(updater, messages)
+    start = time.time()
+    updater.process_updates(workers)
+    return time.time() - start
+
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 2000
+    docs = len(sys.argv) > 2 and int(sys.argv[2]) or 10
+    delay = len(sys.argv) > 3 and float(sys.argv[3]) or 20
+    workers = len(sys.argv) > 4 and int(sys.argv[4]) or 10
+    in_flight = len(sys.argv) > 5 and int(sys.argv[5]) or 100
+
+    solr = FakeSolr(delay=delay / 1000.0).start()
+    amqp = {'queue' : 'bench'}
+    print "%d messages of %d documents, Solr answering after %gms" \
+        % (count, docs, delay)
+    print "%-24s %10s %10s %10s %12s" % ('engine', 'seconds', 'msgs/s',
+                                        'docs/s', 'connections')
+    for name, updater in (
+            ('threaded (%d workers)' % workers,
+             SolrUpdater(amqp, solr.uri, connections=workers)),
+            ('async (%d in flight)' % in_flight,
+             AsyncSolrUpdater(amqp, solr.uri, max_in_flight=in_flight))):
+        solr.reset()
+        seconds = run(updater, make_messages(count, docs), workers)
+        assert solr.stats.get('update') == count, "Updates were lost"
+        print "%-24s %10.2f %10.0f %10.0f %12d" % (
+            name, seconds, count / seconds, count * docs / seconds,
+            solr.stats.get('connections', 0))
+    solr.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,59 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+"""Compare announcer message formats by size and encode/decode time.
+
+Usage: python bench/bench_wire_format.py [DOCS] [FIELDS] [ROUNDS]
+"""
+
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from couchdbsolr2.message import decode, encode
+
+
+def make_message(count, fields):
+    docs = []
+    for i in xrange(count):
+        doc = [('post/section%d/field%d' % (f % 3, f), u'Value %d of document %d' % (f, i))
+               for f in xrange(fields)]
+        doc.extend([('type', 'any'), ('_id', 'doc%06d' % i), ('_db', 'bench')])
+        docs.append(doc)
+    return {'type' : 'updated', 'data' : docs}
+
+
+def main():
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 1000
+    fields = len(sys.argv) > 2 and int(sys.argv[2]) or 20
+    rounds = len(sys.argv) > 3 and int(sys.argv[3]) or 10
+    updates = make_message(count, fields)
+
+    print "%d documents of %d fields, %d rounds" % (count, fields, rounds)
+    print "%-16s %12s %12s %12s" % ('format', 'bytes', 'encode ms', 'decode ms')
+    for format, compress in (('json', False), ('json', True),
+                             ('compact', False), ('compact', True)):
+        start = time.time()
+        for i in xrange(rounds):
+            body, properties = encode(updates, format, compress)
+        encoded = (time.time() - start) / rounds
+        start = time.time()
+        for i in xrange(rounds):
+            decoded = decode(body, properties['content_type'],
+                             properties.get('content_encoding'))
+        decoded_time = (time.time() - start) / rounds
+        assert decoded['data'] == updates['data']
+        name = format + (compress and '+zlib' or '')
+        print "%-16s %12d %12.1f %12.1f" % (name, len(body), encoded * 1000,
+                                            decoded_time * 1000)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
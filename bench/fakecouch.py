@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+"""Minimal in-process fake of the CouchDB HTTP API used by the announcer.
+
+Supports just enough of CouchDB for UpdateAnnouncer: database info,
+_all_docs_by_seq paging, single document GET and multi-key _all_docs
+with include_docs. Every request is counted so benchmarks can report
+round trips.
+"""
+
+import cgi, socket, threading, time, urllib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+__all__ = ['FakeCouchDB']
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, obj, code=200):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self):
+        path, _, query = self.path.partition('?')
+        parts = [urllib.unquote(p) for p in path.split('/') if p]
+        params = dict((k, v[-1]) for k, v in cgi.parse_qs(query).items())
+        return parts, params
+
+    def do_GET(self):
+        parts, params = self._route()
+        couch = self.server.couch
+        couch.count(parts)
+        db = couch.dbs.get(parts and parts[0])
+        if db is None:
+            return self._reply({'error' : 'not_found'}, 404)
+        if len(parts) == 1:
+            return self._reply({'db_name' : parts[0],
+                                'doc_count' : len(db),
+                                'update_seq' : len(db)})
+        if parts[1] == '_all_docs_by_seq':
+            start = json.loads(params.get('startkey', '0'))
+            limit = int(params.get('limit', len(db)))
+            rows = [{'id' : doc['_id'], 'key' : seq,
+                     'value' : {'rev' : doc['_rev']}}
+                    for seq, doc in enumerate(db[start:start + limit], start + 1)]
+            return self._reply({'total_rows' : len(db), 'offset' : start,
+                                'rows' : rows})
+        doc = couch.docs.get((parts[0], '/'.join(parts[1:])))
+        if doc is None:
+            return self._reply({'error' : 'not_found'}, 404)
+        return self._reply(doc)
+
+    def do_POST(self):
+        parts, params = self._route()
+        couch = self.server.couch
+        couch.count(parts)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if len(parts) != 2 or parts[1] != '_all_docs':
+            return self._reply({'error' : 'not_found'}, 404)
+        rows = []
+        for key in json.loads(body)['keys']:
+            doc = couch.docs.get((parts[0], key))
+            if doc is None:
+                rows.append({'key' : key, 'error' : 'not_found'})
+            else:
+                row = {'id' : key, 'key' : key, 'value' : {'rev' : doc['_rev']}}
+                if params.get('include_docs') == 'true':
+                    row['doc'] = doc
+                rows.append(row)
+        return self._reply({'total_rows' : len(rows), 'rows' : rows})
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, *args):
+        HTTPServer.__init__(self, *args)
+        self.clients = set()
+
+    def finish_request(self, request, client_address):
+        self.clients.add(request)
+        try:
+            HTTPServer.finish_request(self, request, client_address)
+        finally:
+            self.clients.discard(request)
+
+    def handle_error(self, request, client_address):
+        # Clients drop keep-alive connections whenever they like
+        pass
+
+    def close_clients(self):
+        for request in list(self.clients):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class FakeCouchDB(object):
+    """Fake CouchDB server listening on a local port.
+
+    """
+
+    def __init__(self, port=0):
+        self.dbs = {}
+        self.docs = {}
+        self.requests = {}
+        self.lock = threading.Lock()
+        self.httpd = _Server(('127.0.0.1', port), _Handler)
+        self.httpd.couch = self
+        self.uri = 'http://127.0.0.1:%d/' % self.httpd.server_address[1]
+
+    def add_docs(self, db_name, docs):
+        """Append documents to a database, assigning sequence numbers."""
+        db = self.dbs.setdefault(db_name, [])
+        for doc in docs:
+            doc.setdefault('_rev', '1')
+            db.append(doc)
+            self.docs[(db_name, doc['_id'])] = doc
+
+    def count(self, parts):
+        if len(parts) < 2:
+            kind = 'info'
+        elif parts[1].startswith('_'):
+            kind = parts[1]
+        else:
+            kind = 'doc'
+        self.lock.acquire()
+        try:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        self.requests = {}
+
+    def total(self):
+        return sum(self.requests.values())
+
+    def start(self):
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.close_clients()
+        time.sleep(0.1)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+"""Minimal in-process fake of the Solr HTTP API.
+
+Answers update requests with a successful XML response and select
+requests with an empty JSON result (or select_response, a string or a
+callable given the request body), optionally after a delay, with the
+HTTP status of status (200, or a callable given the request body). Counts
+connections, requests and bytes received so benchmarks can report them.
+"""
+
+import socket, threading, time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+__all__ = ['FakeSolr']
+
+UPDATE_RESPONSE = '<?xml version="1.0" encoding="UTF-8"?>\n<response>' \
+    '<lst name="responseHeader"><int name="status">0</int>' \
+    '<int name="QTime">0</int></lst></response>'
+
+SELECT_RESPONSE = '{"responseHeader":{"status":0,"QTime":0},' \
+    '"response":{"numFound":0,"start":0,"docs":[]}}'
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.solr.count('connections')
+
+    def _body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            size = int(self.rfile.readline().split(';')[0], 16)
+            while size:
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+                size = int(self.rfile.readline().split(';')[0], 16)
+            self.rfile.readline()
+            return ''.join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_POST(self):
+        solr = self.server.solr
+        body = self._body()
+        solr.count('requests')
+        solr.count('bytes', len(body))
+        solr.bodies.append(body)
+        delay = solr.delay
+        if callable(delay):
+            delay = delay(body)
+        if delay:
+            time.sleep(delay)
+        if self.path.split('?')[0].endswith('/select'):
+            solr.count('select')
+            content, content_type = solr.select_response, 'application/json'
+            if callable(content):
+                content = content(body)
+        else:
+            solr.count('update')
+            content, content_type = UPDATE_RESPONSE, 'application/xml'
+        code = solr.status
+        if callable(code):
+            code = code(body)
+        self.send_response(code)
+        self.send_header('Content-Type', content_type + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, *args):
+        HTTPServer.__init__(self, *args)
+        self.clients = set()
+
+    def finish_request(self, request, client_address):
+        self.clients.add(request)
+        try:
+            HTTPServer.finish_request(self, request, client_address)
+        finally:
+            self.clients.discard(request)
+
+    def handle_error(self, request, client_address):
+        # Clients drop keep-alive connections whenever they like
+        pass
+
+    def close_clients(self):
+        for request in list(self.clients):
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class FakeSolr(object):
+    """Fake Solr server listening on a local port.
+
+    """
+
+    def __init__(self, port=0, delay=0, keep_bodies=False):
+        """Constructor.
+
+        :param port: Port to listen on (0 picks a free one)
+        :param delay: Seconds to wait before answering each request, or a
+                      callable returning them given the request body
+        :param keep_bodies: Whether to keep request bodies in self.bodies
+        """
+        self.delay = delay
+        self.status = 200
+        self.select_response = SELECT_RESPONSE
+        self.stats = {}
+        if keep_bodies:
+            self.bodies = []
+        else:
+            self.bodies = _Discard()
+        self.lock = threading.Lock()
+        self.httpd = _Server(('127.0.0.1', port), _Handler)
+        self.httpd.solr = self
+        self.uri = 'http://127.0.0.1:%d/solr' % self.httpd.server_address[1]
+
+    def count(self, name, n=1):
+        self.lock.acquire()
+        try:
+            self.stats[name] = self.stats.get(name, 0) + n
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        self.stats = {}
+
+    def start(self):
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.close_clients()
+        time.sleep(0.1)
+
+
+class _Discard(object):
+
+    def append(self, item):
+        pass
@@ -6,13 +6,14 @@
 # http://www.opensource.org/licenses/mit-license.php
 # for details.
 
-import couchdb, logging, socket, os
+import couchdb, logging, signal, socket, threading, time, Queue
 import amqplib.client_0_8 as amqp
-
-try:
-    import simplejson as json
-except ImportError:
-    import json
+import metrics
+from batching import BatchSizer
+from checkpoint import CheckpointStore
+from flatten import flatten
+from message import encode
+from spool import SegmentSpool
 
 TYPE_ATTR = 'type'
 
@@ -21,127 +22,760 @@ log = logging.getLogger(__name__)
 __all__ = ['UpdateAnnouncer']
 
 
+def doc_updates(doc_id, doc, max_depth, max_fields):
+    """Normalize the fields of a fetched document.
+
+    :param doc_id: Id of the document
+    :param doc: Document as returned by CouchDB, or None if missing
+    :param max_depth: Max nesting of indexed objects and arrays
+    :param max_fields: Max fields indexed per document
+    :return: List of (path, value) pairs, or None if nothing is indexed
+    """
+    if doc is None:
+        log.warning("Unable to find document in database: '%s'" % doc_id)
+        return
+    fields = doc.get('solr_fields')
+    fields = ["payload", "timesaved"]
+    if not fields:
+        log.debug("Document '%s' does not define solr_fields" % doc_id)
+        return
+    updates = flatten(doc, fields, max_depth, max_fields)
+    updates.extend([('type', 'any'), ('_id', doc_id)])
+    return updates
+
+
+def _doc_bytes(doc):
+    """Estimate the size of a normalized document encoded as JSON.
+
+    """
+    size = 2
+    for path, value in doc:
+        if isinstance(value, basestring):
+            size += len(path) + len(value) + 8
+        else:
+            size += len(path) + 24
+    return size
+
+
+def split_docs(docs, max_docs=0, max_bytes=0):
+    """Split normalized documents into chunks for messages of their own.
+
+    A document estimated larger than max_bytes gets a chunk of its own.
+
+    :param docs: List of documents, each a list of (path, value) pairs
+    :param max_docs: Max documents per chunk, 0 for no limit
+    :param max_bytes: Max estimated size of the JSON encoding of a chunk,
+                      0 for no limit
+    :return: List of chunks, in order
+    """
+    if max_docs <= 0 and max_bytes <= 0:
+        return [docs]
+    chunks = []
+    chunk = []
+    size = 0
+    for doc in docs:
+        doc_size = 0
+        if max_bytes > 0:
+            doc_size = _doc_bytes(doc)
+        if chunk and ((max_docs > 0 and len(chunk) >= max_docs) or
+                      (max_bytes > 0 and size + doc_size > max_bytes)):
+            chunks.append(chunk)
+            chunk = []
+            size = 0
+        chunk.append(doc)
+        size += doc_size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _encode_docs(args):
+    """Normalize and serialize a chunk of documents in a worker process.
+
+    Takes a single tuple so it can be handed to a multiprocessing pool.
+
+    :return: List of tuples of message body and AMQP message properties,
+             empty if none of the documents has fields to index
+    """
+    (header, docs, max_depth, max_fields, format, compress, max_docs,
+     max_bytes) = args
+    updates = []
+    for doc_id, doc in docs:
+        fields = doc_updates(doc_id, doc, max_depth, max_fields)
+        if fields is not None:
+            fields.append(('_db', header['db']))
+            updates.append(fields)
+    if not updates:
+        return []
+    return [encode(dict(header, type='updated', data=chunk), format, compress)
+            for chunk in split_docs(updates, max_docs, max_bytes)]
+
+
+def _ignore_sigint():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
 class UpdateAnnouncer(object):
     """Send notification of database updates to AMQP broker.
 
     """
 
-    def __init__(self, amqp, couchdb_uri, seqid_file, batch_size=1000):
+    def __init__(self, amqp, couchdb_uri, seqid_file, batch_size=1000,
+                 bulk_fetch=100, pipeline_workers=0, message_format='json',
+                 compress=False, max_depth=64, max_fields=100000,
+                 processes=0, min_batch=None, max_batch=None,
+                 target_bytes=1024 * 1024, target_latency=2.0,
+                 max_message_docs=0, max_message_bytes=0, spool_dir=None,
+                 spool_segment_bytes=16 * 1024 * 1024, reconnect_interval=5.0,
+                 connect_timeout=5.0, publish_timeout=30.0):
         """Constructor.
 
         :param amqp: AMQP configuration
         :param couchdb_uri: CouchDB URI
-        :param seqid_file: Path to file containing last sequence id
-        :param batch_size: Max updated documents to pull at once
+        :param seqid_file: Path to file checkpointing last sequence ids
+        :param batch_size: Updated documents to pull at once, at first if
+                           min_batch and max_batch differ
+        :param bulk_fetch: Max documents to fetch per multi-key request
+                           (0 fetches documents one at a time)
+        :param pipeline_workers: Threads fetching and normalizing documents
+                                 while pages are prefetched and published
+                                 (0 processes pages one after another)
+        :param message_format: Wire format of messages, see message.formats
+        :param compress: Whether to compress messages with zlib
+        :param max_depth: Max nesting of indexed objects and arrays
+        :param max_fields: Max fields indexed per document
+        :param processes: Worker processes normalizing and serializing
+                          fetched documents (0 does it in process)
+        :param min_batch: Smallest page size (default: batch_size)
+        :param max_batch: Largest page size (default: batch_size)
+        :param target_bytes: Bytes of messages per page that page sizes
+                             aim at (see batching.BatchSizer)
+        :param target_latency: Seconds per page that page sizes aim at
+        :param max_message_docs: Max documents per message, 0 for no limit
+        :param max_message_bytes: Max estimated size of the documents of a
+                                  message, 0 for no limit (see split_docs)
+        :param spool_dir: Directory spooling messages while the AMQP broker
+                          is unreachable (see spool.SegmentSpool), or None
+                          to fail when it is
+        :param spool_segment_bytes: Size of spool segment files
+        :param reconnect_interval: Seconds between attempts to reconnect to
+                                   the broker while messages are spooled
+        :param connect_timeout: Seconds to wait for the broker to accept a
+                                connection
+        :param publish_timeout: Seconds a publish or commit may block before
+                                the broker is taken as gone
         """
         self.amqp = amqp
+        self.couchdb_uri = couchdb_uri
         self.server = couchdb.Server(couchdb_uri)
         self.seqid_file = seqid_file
+        self.checkpoints = CheckpointStore(seqid_file)
         self.batch_size = batch_size
+        self.min_batch = min_batch or batch_size
+        self.max_batch = max_batch or batch_size
+        self.target_bytes = target_bytes
+        self.target_latency = target_latency
+        self.max_message_docs = max_message_docs
+        self.max_message_bytes = max_message_bytes
+        self._sizers = {}
+        self._sizers_lock = threading.Lock()
+        self.bulk_fetch = bulk_fetch
+        self.pipeline_workers = pipeline_workers
+        self.message_format = message_format
+        self.compress = compress
+        self.max_depth = max_depth
+        self.max_fields = max_fields
+        self._local = threading.local()
+        self._local.server = self.server
+        self._publish_lock = threading.Lock()
+        self.connected = False
+        self.stopping = False
+        self.reconnect_interval = reconnect_interval
+        self.connect_timeout = connect_timeout
+        self.publish_timeout = publish_timeout
+        # Messages published in the open transaction, with a spool
+        self._uncommitted = []
+        self.spool = None
+        if spool_dir:
+            self.spool = SegmentSpool(spool_dir, spool_segment_bytes)
+            metrics.gauge('index.spooled', lambda: len(self.spool))
+        self._pool = None
+        if processes > 0:
+            self._pool = self._start_pool(processes)
+
+    def _start_pool(self, processes):
+        """Start the worker processes, or return None if that fails.
+
+        """
+        try:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes, _ignore_sigint)
+        except ImportError:
+            log.warning("multiprocessing is not available, normalizing "
+                        "documents in process")
+            return None
+        except OSError:
+            log.exception("Unable to start worker processes, normalizing "
+                          "documents in process")
+            return None
+        log.info("Started %d worker process(es)" % processes)
+        return pool
+
+    def _encode(self, updates):
+        """Serialize an update message.
+
+        :return: Tuple of message type, body and AMQP message properties
+        """
+        body, properties = encode(updates, self.message_format, self.compress)
+        return updates['type'], body, properties
+
+    def _publish(self, taipu, body, properties):
+        """Send a serialized message out on message queue.
+
+        With a spool, the message is spooled instead if the broker is
+        unreachable or messages spooled before it are still waiting, so
+        that messages reach the broker in order. Otherwise it is published
+        in a transaction, which _commit ends.
+        """
+        log.debug("Sending '%s' message of %d bytes" % (taipu, len(body)))
+        self._publish_lock.acquire()
+        try:
+            if self.spool is None:
+                self._send(body, properties)
+            else:
+                self._drain()
+                if len(self.spool) or not self._send(body, properties):
+                    self.spool.append(body, properties)
+                    metrics.incr('index.spooled_messages')
+                else:
+                    self._uncommitted.append((body, properties))
+        finally:
+            self._publish_lock.release()
+        metrics.incr('index.messages')
+        metrics.incr('index.message_bytes', len(body))
+
+    def _send(self, body, properties):
+        """Publish a message. Must be called with _publish_lock held.
+
+        :return: False if there is a spool and the broker is unreachable
+        """
+        if self.spool is not None and not self.connected:
+            return False
+        msg = amqp.Message(body, **properties)
+        start = time.time()
+        try:
+            self.channel.basic_publish(msg, self.amqp['routing_key'])
+        except (socket.error, IOError, amqp.AMQPException):
+            if self.spool is None:
+                raise
+            log.exception("Lost connection to AMQP broker, spooling "
+                          "messages to '%s'" % self.spool.directory)
+            self._disconnect()
+            return False
+        metrics.observe('amqp.publish', time.time() - start)
+        return True
+
+    def _commit(self):
+        """Have the broker take the messages published so far.
+
+        With a spool, a successful basic_publish only means the message
+        reached the socket buffer, so messages are published in a
+        transaction, committed before their page is checkpointed. If the
+        commit fails, its messages are spooled (see _disconnect).
+
+        :return: False if the commit failed
+        """
+        if self.spool is None:
+            return True
+        self._publish_lock.acquire()
+        try:
+            if not self.connected:
+                return False
+            start = time.time()
+            try:
+                self.channel.tx_commit()
+            except (socket.error, IOError, amqp.AMQPException):
+                log.exception("Lost connection to AMQP broker, spooling "
+                              "messages to '%s'" % self.spool.directory)
+                self._disconnect()
+                return False
+            self._uncommitted = []
+            metrics.observe('amqp.commit', time.time() - start)
+            return True
+        finally:
+            self._publish_lock.release()
+
+    def _drain(self):
+        """Publish spooled messages, in order, while the broker takes them.
+
+        Must be called with _publish_lock held.
+        """
+        if not len(self.spool) or self.stopping or not self.connected:
+            return
+        while True:
+            message = self.spool.peek()
+            if message is None or not self._send(*message):
+                return
+            # Committed one by one, as the spool only hands out its head
+            start = time.time()
+            try:
+                self.channel.tx_commit()
+            except (socket.error, IOError, amqp.AMQPException):
+                log.exception("Lost connection to AMQP broker while "
+                              "publishing spooled messages")
+                self._disconnect()
+                return
+            metrics.observe('amqp.commit', time.time() - start)
+            self.spool.consume()
+            metrics.incr('index.unspooled_messages')
+
+    def __drain_spooled(self):
+        """Reconnect to the broker every reconnect_interval while it is
+        unreachable, and publish what was spooled meanwhile.
+
+        Connecting is done without _publish_lock held, so that publishing
+        keeps spooling messages while the broker does not answer.
+        """
+        log.info("Started thread to publish spooled messages")
+        while not self.stopping:
+            time.sleep(self.reconnect_interval)
+            if not self.connected and not self.stopping:
+                if not self._connect():
+                    continue
+                log.info("Reconnected to AMQP broker")
+            self._publish_lock.acquire()
+            try:
+                try:
+                    self._drain()
+                except Exception:
+                    log.exception("Unable to publish spooled messages")
+            finally:
+                self._publish_lock.release()
 
     def _announce_updates(self, updates):
         """Send updates out on message queue.
 
         :param updates: Update structure to be serialized and sent
         """
-        serialized = json.dumps(updates)
-        log.debug('Sending serialized message: ' + serialized)
-        msg = amqp.Message(serialized, content_type='application/json')
-        self.channel.basic_publish(msg, self.amqp['routing_key'])
+        self._publish(*self._encode(updates))
 
     def start_amqp(self):
         """Connect to AMQP broker.
 
+        With a spool, an unreachable broker is not an error: messages are
+        spooled until it is back.
+
+        :return: False if the broker is unreachable and there is no spool
+        """
+        connected = self._connect()
+        if self.spool is None:
+            return connected
+        if not connected:
+            log.warning("AMQP broker is unreachable, spooling messages to "
+                        "'%s'" % self.spool.directory)
+        elif len(self.spool):
+            log.info("%d message(s) spooled" % len(self.spool))
+        drainer = threading.Thread(target=self.__drain_spooled)
+        drainer.setDaemon(True)
+        drainer.start()
+        return True
+
+    def _connect(self):
+        """Connect to the broker, then use the connection for publishing.
+
+        Must be called without _publish_lock held.
+
+        :return: Whether the broker is reachable
         """
         try:
-            self.conn = amqp.Connection(self.amqp['host'], self.amqp['user'],
-                                        self.amqp['password'],
-                                        virtual_host=self.amqp['vhost'])
-            self.channel = self.conn.channel()
-            self.channel.exchange_declare(self.amqp['routing_key'], 'fanout')
-        except socket.error:
+            conn = amqp.Connection(self.amqp['host'], self.amqp['user'],
+                                   self.amqp['password'],
+                                   virtual_host=self.amqp['vhost'],
+                                   connect_timeout=self.connect_timeout)
+            # amqplib drops the timeout once connected. A broker gone
+            # without a reset would block publishing for good, and a timeout
+            # is a socket.error, taken as a lost connection.
+            conn.transport.sock.settimeout(self.publish_timeout)
+            channel = conn.channel()
+            channel.exchange_declare(self.amqp['routing_key'], 'fanout')
+            if self.spool is not None:
+                channel.tx_select()
+        except (socket.error, IOError, amqp.AMQPException), e:
+            log.error("Unable to connect to AMQP broker: %s" % e)
             return False
+        self._publish_lock.acquire()
+        try:
+            self.conn, self.channel = conn, channel
+            if self.stopping:
+                self._disconnect()
+                return False
+            self.connected = True
+        finally:
+            self._publish_lock.release()
         return True
 
-    def shutdown(self):
-        """Clean up AMQP resources.
+    def _disconnect(self):
+        """Drop the connection. Must be called with _publish_lock held.
 
+        The open transaction is lost with it, so its messages are spooled.
         """
-        self.channel.close()
-        self.conn.close()
-
-    def __normalize(self, updates, path, obj):
-        if obj is None:
+        self.connected = False
+        # Closing the connection would wait for the broker to answer
+        try:
+            self.conn.transport.close()
+        except Exception:
             pass
-        elif isinstance(obj, str) or isinstance(obj, int) or isinstance(obj, float) or isinstance(obj, long) or isinstance(obj, unicode):
-            updates.append({path : obj})
-        elif isinstance(obj, list):
-            self.__normalize_list(updates, path, obj)
-        elif isinstance(obj, dict):
-            self.__normalize_dict(updates, path, obj)
-        else:
-            log.error("Unhandled field type: " + str(type(obj)))
+        for body, properties in self._uncommitted:
+            self.spool.append(body, properties)
+            metrics.incr('index.spooled_messages')
+        self._uncommitted = []
 
-    def __normalize_list(self, updates, path, obj):
-        for i, elem in enumerate(obj):
-            if path:
-                ext_path = "%s/$%d" % (path, i)
-            else:
-                ext_path = "$%d" % i
-            self.__normalize(updates, ext_path, elem)
+    def shutdown(self):
+        """Clean up AMQP resources.
 
-    def __normalize_dict(self, updates, path, obj):
-        for field in obj.keys():
-            if path:
-                ext_path = "%s/%s" % (path, field)
-            else:
-                ext_path = field
-            self.__normalize(updates, ext_path, obj[field])
+        Messages published afterwards are spooled, if there is a spool.
+        """
+        self.stopping = True
+        if self.connected:
+            self.connected = False
+            try:
+                self.channel.close()
+                self.conn.close()
+            except (socket.error, IOError, amqp.AMQPException):
+                log.exception("Problem closing connection to AMQP broker")
+        if self._pool is not None:
+            self._pool.terminate()
+
+    def _fetch_docs(self, db, doc_ids):
+        """Fetch documents in chunks of at most bulk_fetch ids.
+
+        Each chunk is a single POST to _all_docs with include_docs set,
+        instead of one GET per document.
+
+        :param db: Database holding the documents
+        :param doc_ids: Ids of documents to fetch
+        :return: Iterator of (doc_id, doc) pairs in the order of doc_ids.
+                 doc is None for documents that could not be found.
+        """
+        for i in xrange(0, len(doc_ids), self.bulk_fetch):
+            chunk = doc_ids[i:i + self.bulk_fetch]
+            found = {}
+            start = time.time()
+            for row in db.view('_all_docs', keys=chunk, include_docs=True):
+                if row.get('doc') is not None:
+                    found[row.key] = row.doc
+            metrics.observe('couchdb.fetch', time.time() - start)
+            for doc_id in chunk:
+                yield doc_id, found.get(doc_id)
+
+    def _doc_updates(self, doc_id, doc):
+        """Normalize the fields of a fetched document.
+
+        :param doc_id: Id of the document
+        :param doc: Document as returned by CouchDB, or None if missing
+        """
+        return doc_updates(doc_id, doc, self.max_depth, self.max_fields)
 
-    def _index_doc(self, db, doc_id):
-        """Collect document fields to be indexed by Solr.
+    def next_in_sequence(self, db, seq_id, sizer=None):
+        """Page through _all_docs_by_seq after a sequence id.
 
+        :param db: Database
+        :param seq_id: Sequence id to start after
+        :param sizer: BatchSizer choosing the size of every page when it is
+                      read, or None for pages of batch_size
+        :return: Iterator of (rows, row count, sequence id of the last row,
+                 seconds it took to read the page)
         """
-        doc = db.get(doc_id)
-        if doc is None:
-            log.warning("Unable to find document in database: '%s'" % doc_id)
-            return
-        fields = doc.get('solr_fields')
-        fields = ["payload", "timesaved"]
-        if not fields:
-            log.debug("Document '%s' does not define solr_fields" % doc_id)
-            return
-        updates = []
-        for field in fields:
-            if doc.has_key(field):
-                self.__normalize(updates, field, doc[field])
-        updates.extend([{'type' : 'any'}, {'_id' : doc_id}])
-        return updates
-
-    def next_in_sequence(self, db, seq_id):
         try:
-            updated_docs = db.view('_all_docs_by_seq', startkey=seq_id,
-                                   limit=self.batch_size)
-            len_docs = len(updated_docs)
-            while len_docs > 0:
-                seq_id = updated_docs.rows[len_docs - 1].key
-                yield (updated_docs, len_docs, seq_id)
+            while True:
+                limit = sizer is not None and sizer.size or self.batch_size
+                start = time.time()
                 updated_docs = db.view('_all_docs_by_seq', startkey=seq_id,
-                                       limit=self.batch_size)
+                                       limit=limit)
                 len_docs = len(updated_docs)
+                seconds = time.time() - start
+                metrics.observe('couchdb.view', seconds)
+                if len_docs == 0:
+                    break
+                seq_id = updated_docs.rows[len_docs - 1].key
+                yield (updated_docs, len_docs, seq_id, seconds)
         except socket.error:
             log.exception('Problem connecting to database')
 
+    def _sizer(self, db_name):
+        """BatchSizer of a database.
+
+        """
+        self._sizers_lock.acquire()
+        try:
+            sizer = self._sizers.get(db_name)
+            if sizer is None:
+                sizer = BatchSizer(self.batch_size, self.min_batch,
+                                   self.max_batch, self.target_bytes,
+                                   self.target_latency)
+                self._sizers[db_name] = sizer
+                metrics.gauge('index.batch_size.' + db_name,
+                              lambda: sizer.size)
+            return sizer
+        finally:
+            self._sizers_lock.release()
+
     def read_sequence_ids(self):
-        if os.path.exists(self.seqid_file):
+        return self.checkpoints.snapshot()
+
+    def write_sequence_ids(self, seqids):
+        self.checkpoints.replace(seqids)
+
+    def _database(self, db_name):
+        """Get a database handle owned by the calling thread.
+
+        couchdb.Server is not safe to share between threads, so pipeline
+        stages and scheduler workers each use their own.
+        """
+        server = getattr(self._local, 'server', None)
+        if server is None:
+            server = self._local.server = couchdb.Server(self.couchdb_uri)
+        return server[db_name]
+
+    def _fetched_docs(self, db, doc_ids):
+        """Yield (doc_id, doc) pairs, in bulk if bulk_fetch is set.
+
+        """
+        if self.bulk_fetch > 0:
+            return self._fetch_docs(db, doc_ids)
+        return self._get_docs(db, doc_ids)
+
+    def _get_docs(self, db, doc_ids):
+        for doc_id in doc_ids:
+            start = time.time()
+            doc = db.get(doc_id)
+            metrics.observe('couchdb.fetch', time.time() - start)
+            yield doc_id, doc
+
+    def _pooled_messages(self, db, header, doc_ids):
+        """Have the worker processes build the messages for doc_ids.
+
+        Documents are handed over in chunks as they are fetched, each
+        chunk becoming one or more messages of its own, so fetching the
+        next chunk overlaps with normalizing the previous ones.
+
+        :param header: Members of the messages besides type and data
+        :return: List of serialized messages, in the order of doc_ids
+        """
+        chunk_size = self.bulk_fetch or 100
+        results = []
+        chunk = []
+
+        def submit(chunk):
+            args = (header, chunk, self.max_depth, self.max_fields,
+                    self.message_format, self.compress,
+                    self.max_message_docs, self.max_message_bytes)
+            results.append(self._pool.apply_async(_encode_docs, (args,)))
+
+        for doc_id, doc in self._fetched_docs(db, doc_ids):
+            if doc is not None:
+                doc = dict(doc)
+            chunk.append((doc_id, doc))
+            if len(chunk) >= chunk_size:
+                submit(chunk)
+                chunk = []
+        if chunk:
+            submit(chunk)
+
+        messages = []
+        start = time.time()
+        for result in results:
+            for encoded in result.get():
+                messages.append(('updated',) + encoded)
+        metrics.observe('index.pool_wait', time.time() - start)
+        return messages
+
+    def _batch_messages(self, db, db_name, rows, seqid):
+        """Build the messages announcing one page of _all_docs_by_seq.
+
+        :param db: Database the rows were read from
+        :param db_name: Name of the database
+        :param rows: Rows of the page
+        :param seqid: Sequence id of the last row
+        :return: List of serialized messages (see _encode), in the order
+                 they must be sent. Deleted and updated documents are split
+                 over as many messages as max_message_docs and
+                 max_message_bytes require.
+        """
+        deleted_docs = [doc.id for doc in rows
+                        if doc.value.get('deleted', False)]
+        updated_docs = [doc.id for doc in rows
+                        if not doc.value.get('deleted', False)]
+
+        metrics.incr('index.deleted_docs', len(deleted_docs))
+        metrics.incr('index.updated_docs', len(updated_docs))
+        header = {'db' : db_name, 'seq' : seqid, 'ts' : time.time()}
+        messages = []
+        step = self.max_message_docs or max(len(deleted_docs), 1)
+        for i in xrange(0, len(deleted_docs), step):
+            messages.append(self._encode(dict(header, type='deleted',
+                                              data=deleted_docs[i:i + step])))
+
+        if updated_docs and self._pool is not None:
+            messages.extend(self._pooled_messages(db, header, updated_docs))
+        elif updated_docs:
+            updates = []
+            normalizing = 0.0
+            for doc_id, doc in self._fetched_docs(db, updated_docs):
+                start = time.time()
+                doc_updates = self._doc_updates(doc_id, doc)
+                normalizing += time.time() - start
+                if doc_updates is not None:
+                    doc_updates.append(('_db', db_name))
+                    updates.append(doc_updates)
+            metrics.observe('index.normalize', normalizing)
+            if updates:
+                start = time.time()
+                for chunk in split_docs(updates, self.max_message_docs,
+                                        self.max_message_bytes):
+                    messages.append(self._encode(dict(header, type='updated',
+                                                      data=chunk)))
+                metrics.observe('index.encode', time.time() - start)
+        # Where each message stands in its page, so the updater can tell
+        # once all of the page reached Solr. In the AMQP headers, since
+        # pooled messages are serialized already.
+        count = len(messages)
+        return [(taipu, body, dict(properties, application_headers={
+                     'db' : db_name, 'seq' : seqid,
+                     'chunk' : i, 'chunks' : count}))
+                for i, (taipu, body, properties) in enumerate(messages)]
+
+    def _page_messages(self, db, db_name, rows, new_seqid, read_seconds,
+                       sizer):
+        """Build the messages of a page and adapt the page size to it.
+
+        :param read_seconds: Time it took to read the page
+        :param sizer: BatchSizer of the database
+        """
+        start = time.time()
+        messages = self._batch_messages(db, db_name, rows, new_seqid)
+        size_bytes = 0
+        for message in messages:
+            size_bytes += len(message[1])
+        sizer.observe(len(rows), read_seconds + time.time() - start,
+                      size_bytes)
+        return messages
+
+    def _batches(self, db_name, seqid):
+        """Yield (seqid, messages) for each page, one page at a time.
+
+        """
+        db = self._database(db_name)
+        log.debug("Connected to database '%s'" % db_name)
+        sizer = self._sizer(db_name)
+        for updated_docs, len_docs, new_seqid, seconds in \
+                self.next_in_sequence(db, seqid, sizer):
+            log.info("Processing %d update(s)" % len_docs)
+            yield new_seqid, self._page_messages(db, db_name, updated_docs,
+                                                 new_seqid, seconds, sizer)
+
+    def _pipelined_batches(self, db_name, seqid):
+        """Yield (seqid, messages) for each page, in sequence order.
+
+        A prefetcher thread pages through _all_docs_by_seq while a pool of
+        pipeline_workers threads fetches and normalizes documents. The
+        caller publishes what is yielded, so publishing overlaps with both.
+        Bounded queues between the stages keep at most a few pages in
+        memory. A page that fails to process stops the pipeline; nothing
+        after it is yielded.
+        """
+        workers = self.pipeline_workers
+        pages = Queue.Queue(workers * 2)
+        results = Queue.Queue(workers * 2)
+        abort = threading.Event()
+        sizer = self._sizer(db_name)
+
+        def prefetch():
             try:
-                return json.load(file(self.seqid_file))
+                db = self._database(db_name)
+                log.debug("Connected to database '%s'" % db_name)
+                index = 0
+                for updated_docs, len_docs, new_seqid, seconds in \
+                        self.next_in_sequence(db, seqid, sizer):
+                    if abort.isSet():
+                        break
+                    log.info("Processing %d update(s)" % len_docs)
+                    pages.put((index, new_seqid, updated_docs.rows, seconds))
+                    index += 1
             except Exception:
-                log.exception('Error reading sequence id file')
-        return {}
+                log.exception("Problem reading updates of '%s'" % db_name)
+            for i in xrange(workers):
+                pages.put(None)
+
+        def work():
+            db = self._database(db_name)
+            page = pages.get()
+            while page is not None:
+                index, new_seqid, rows, seconds = page
+                messages = None
+                if not abort.isSet():
+                    try:
+                        messages = self._page_messages(db, db_name, rows,
+                                                       new_seqid, seconds,
+                                                       sizer)
+                    except Exception:
+                        log.exception("Problem processing updates of '%s'"
+                                      % db_name)
+                results.put((index, new_seqid, messages))
+                page = pages.get()
+            results.put(None)
+
+        threads = [threading.Thread(target=prefetch)]
+        threads.extend([threading.Thread(target=work) for i in xrange(workers)])
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+
+        running = workers
+        pending = {}
+        next_index = 0
+        try:
+            while running:
+                result = results.get()
+                if result is None:
+                    running -= 1
+                    continue
+                pending[result[0]] = result
+                while pending.has_key(next_index):
+                    index, new_seqid, messages = pending.pop(next_index)
+                    if messages is None:
+                        raise Exception, "Failed to process updates of '%s' " \
+                            "up to sequence id %s" % (db_name, new_seqid)
+                    yield new_seqid, messages
+                    next_index += 1
+        finally:
+            abort.set()
+            while running:
+                if results.get() is None:
+                    running -= 1
+            for thread in threads:
+                thread.join()
+
+    def _last_seqid(self, db_name):
+        """Current update sequence of a database, or None if unknown.
 
-    def write_sequence_ids(self, seqids):
-        json.dump(seqids, file(self.seqid_file, 'w'))
+        """
+        try:
+            return self._database(db_name).info()['update_seq']
+        except Exception:
+            log.exception("Unable to read update sequence of '%s'" % db_name)
+            return None
+
+    def _lag(self, db_name):
+        """Changes of a database not announced yet, or None if unknown.
+
+        Read when metrics are reported, to keep CouchDB requests off the
+        path of notifications.
+        """
+        last_seqid = self._last_seqid(db_name)
+        if last_seqid is None:
+            return None
+        return max(last_seqid - self.checkpoints.get(db_name, 0), 0)
 
     def update_index(self, db_name):
         """Announce updates to a database
@@ -149,41 +783,35 @@ class UpdateAnnouncer(object):
         For messages announcing deleted documents, the type is 'deleted'
         and data is a list of the ids of the deleted documents.
 
-        For updated documents, the type is 'updated'. FIXME: list
-        of lists of dictionaries should be made into a list of dictionaries.
+        For updated documents, the type is 'updated' and data is a list
+        of documents, each a list of (field path, value) pairs. How that
+        is laid out on the wire depends on message_format (see message.py).
+
+        Both also carry the name of the database as db, the sequence id up
+        to which the page of the message reaches as seq, and the time the
+        page was read as ts, so the updater can report what Solr caught
+        up with. Their AMQP headers repeat db and seq, with the index of
+        the message in its page as chunk and the number of messages of
+        the page as chunks.
+
+        Messages are published in sequence order and the sequence id is
+        checkpointed after each page once all of its messages went out
+        (with a spool, once the broker committed or they were spooled), so
+        an interrupted catch-up resumes with the first unpublished page.
 
         :param db_name: Name of updated database
         """
-        db = self.server[db_name]
-        log.debug("Connected to database '%s'" % db_name)
-
-        seqids = self.read_sequence_ids()
-        seqid = seqids.get(db_name, 0)
-        for updated_docs, len_docs, new_seqid in self.next_in_sequence(db, seqid):
-            log.info("Processing %d update(s)" % len_docs)
-            seqid = new_seqid
-
-            deleted_docs = [doc.id for doc in updated_docs
-                            if doc.value.get('deleted', False)]
-            updated_docs = [doc.id for doc in updated_docs
-                            if not doc.value.get('deleted', False)]
-
-            if deleted_docs:
-                deletes = {'type' : 'deleted', 'data' : deleted_docs}
-                self._announce_updates(deletes)
-
-            if updated_docs:
-                updates = []
-                for doc_id in updated_docs:
-                    doc_updates = self._index_doc(db, doc_id)
-                    if doc_updates is not None:
-                        doc_updates.append({'_db' : db_name})
-                        updates.append(doc_updates)
-                if updates:
-                    self._announce_updates({'type' : 'updated', 'data' : updates})
-
-        seqids.update({db_name : seqid})
-        self.write_sequence_ids(seqids)
+        seqid = self.checkpoints.get(db_name, 0)
+        metrics.gauge('index.lag.' + db_name, lambda: self._lag(db_name))
+        if self.pipeline_workers > 0:
+            batches = self._pipelined_batches(db_name, seqid)
+        else:
+            batches = self._batches(db_name, seqid)
+        for new_seqid, messages in batches:
+            for message in messages:
+                self._publish(*message)
+            self._commit()
+            self.checkpoints.set(db_name, new_seqid)
 
     def delete_database(self, db_name):
         """Announce that database was deleted.
@@ -193,8 +821,13 @@ class UpdateAnnouncer(object):
 
         :param db_name: Name of deleted database
         """
-        seqids = self.read_sequence_ids()
-        if seqids.has_key(db_name):
-            del seqids[db_name]
-            self.write_sequence_ids(seqids)
+        self.checkpoints.delete(db_name)
+        metrics.remove_gauge('index.lag.' + db_name)
+        self._sizers_lock.acquire()
+        try:
+            self._sizers.pop(db_name, None)
+            metrics.remove_gauge('index.batch_size.' + db_name)
+        finally:
+            self._sizers_lock.release()
         self._announce_updates({'type' : 'deleted_db', 'data' : db_name})
+        self._commit()
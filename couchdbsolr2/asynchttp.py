@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+"""Non-blocking HTTP/1.1 client running on an asyncore event loop.
+
+One thread multiplexes many keep-alive connections to a single host, so
+hundreds of requests can be in flight without a thread each. Any thread
+may post requests; their callbacks run in the thread of the event loop.
+"""
+
+import asyncore, errno, fcntl, logging, os, socket, sys, threading, time
+import urlparse
+
+log = logging.getLogger(__name__)
+
+__all__ = ['AsyncHTTPClient']
+
+_SEND_SIZE = 256 * 1024
+
+
+class _Request(object):
+
+    def __init__(self, method, path, body, headers, callback):
+        self.method = method
+        self.path = path
+        self.body = body
+        self.headers = headers
+        self.callback = callback
+        self.attempts = 2
+
+
+def _dechunk(data):
+    """Decode a chunked response body.
+
+    :return: The content, or None if data does not hold all of it yet
+    """
+    chunks = []
+    pos = 0
+    while True:
+        end = data.find('\r\n', pos)
+        if end < 0:
+            return None
+        size = int(data[pos:end].split(';')[0], 16)
+        pos = end + 2
+        if size == 0:
+            # Skip trailers up to the empty line ending the body
+            if data.find('\r\n', pos) < 0:
+                return None
+            return ''.join(chunks)
+        if len(data) < pos + size + 2:
+            return None
+        chunks.append(data[pos:pos + size])
+        pos += size + 2
+
+
+class _Connection(asyncore.dispatcher):
+    """Keep-alive connection running one request at a time.
+
+    """
+
+    def __init__(self, client):
+        asyncore.dispatcher.__init__(self, map=client.map)
+        self.client = client
+        self.request = None
+        self.out = ''
+        self.offset = 0
+        self.data = []
+        self.received = 0
+        self.used = time.time()
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connect(client.address)
+
+    def start(self, request):
+        self.request = request
+        lines = ['%s %s HTTP/1.1' % (request.method, request.path),
+                 'Host: %s' % self.client.host,
+                 'Content-Length: %d' % len(request.body)]
+        for header, value in request.headers.items():
+            lines.append('%s: %s' % (header, value))
+        self.out = '\r\n'.join(lines) + '\r\n\r\n' + request.body
+        self.offset = 0
+        self.data = []
+        self.received = 0
+
+    def writable(self):
+        return not self.connected or self.offset < len(self.out)
+
+    def readable(self):
+        return True
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(buffer(self.out, self.offset, _SEND_SIZE))
+        self.offset += sent
+        if self.offset >= len(self.out):
+            self.out = ''
+            self.offset = 0
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+        if self.request is None:
+            # Nothing was asked, the server is closing
+            self.close()
+            return
+        self.data.append(data)
+        self.received += len(data)
+        self._parse()
+
+    def _parse(self):
+        data = ''.join(self.data)
+        self.data = [data]
+        head_end = data.find('\r\n\r\n')
+        if head_end < 0:
+            return
+        lines = data[:head_end].split('\r\n')
+        status = int(lines[0].split(' ', 2)[1])
+        headers = {}
+        for line in lines[1:]:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+        body = data[head_end + 4:]
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            content = _dechunk(body)
+            if content is None:
+                return
+        elif headers.has_key('content-length'):
+            length = int(headers['content-length'])
+            if len(body) < length:
+                return
+            content = body[:length]
+        else:
+            # Read until the server closes the connection
+            return
+        keep_alive = headers.get('connection', '').lower() != 'close'
+        self._finish(status, content, keep_alive)
+
+    def _finish(self, status, content, keep_alive):
+        request = self.request
+        self.request = None
+        self.data = []
+        if not keep_alive:
+            self.close()
+        self.client._finished(self, request, status, content)
+
+    def handle_close(self):
+        request = self.request
+        if request is not None and self.data:
+            data = ''.join(self.data)
+            head_end = data.find('\r\n\r\n')
+            if head_end >= 0 and 'content-length' not in data[:head_end].lower() \
+                    and 'chunked' not in data[:head_end].lower():
+                status = int(data.split(' ', 2)[1])
+                self._finish(status, data[head_end + 4:], False)
+                return
+        self.close()
+        self.request = None
+        self.client._failed(self, request)
+
+    def handle_error(self):
+        error = sys.exc_info()[1]
+        if isinstance(error, socket.error):
+            log.error("HTTP error: %s" % error)
+        else:
+            log.exception("HTTP error")
+        request = self.request
+        self.close()
+        self.request = None
+        self.client._failed(self, request)
+
+    def close(self):
+        if self.socket is not None:
+            asyncore.dispatcher.close(self)
+            self.client._closed(self)
+
+
+class _Waker(asyncore.file_dispatcher):
+    """Read end of a pipe that wakes the event loop up.
+
+    """
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def handle_close(self):
+        pass
+
+
+class AsyncHTTPClient(object):
+    """Client keeping up to max_connections requests in flight to a host.
+
+    Requests posted beyond that wait for a free connection. A request
+    that fails on a reused connection before a response arrived is
+    retried once on a fresh one, as the server may have dropped the idle
+    connection. Callbacks are given the response status and content, or
+    None and None if the request failed.
+    """
+
+    def __init__(self, uri, max_connections=100, idle_timeout=15):
+        """Constructor.
+
+        :param uri: Base URI of the host, http only
+        :param max_connections: Max requests in flight
+        :param idle_timeout: Seconds after which idle connections are
+                             closed instead of reused
+        """
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(uri)
+        if scheme != 'http':
+            raise ValueError, "Unsupported scheme '%s'" % scheme
+        self.host = netloc
+        host, port = netloc, 80
+        if ':' in netloc:
+            host, port = netloc.rsplit(':', 1)
+            port = int(port)
+        self.address = (host, port)
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.map = {}
+        self.lock = threading.Lock()
+        self.posted = []
+        self.waiting = []
+        self.idle = []
+        self.connections = set()
+        self.in_flight = 0
+        self.stopping = False
+        self.thread = None
+        self.wake_read, self.wake_write = os.pipe()
+        flags = fcntl.fcntl(self.wake_write, fcntl.F_GETFL)
+        fcntl.fcntl(self.wake_write, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.waker = _Waker(self.wake_read, map=self.map)
+
+    def post(self, url, body, headers, callback):
+        """Post a request. Safe to call from any thread.
+
+        :param url: URL on the host of the client
+        :param body: Request body, a string
+        :param headers: Dictionary of request headers
+        :param callback: Called with status and content once done
+        """
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        if query:
+            path += '?' + query
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        request = _Request('POST', path, body, headers, callback)
+        self.lock.acquire()
+        try:
+            self.posted.append(request)
+            self.in_flight += 1
+        finally:
+            self.lock.release()
+        self._wake()
+
+    def _wake(self):
+        try:
+            os.write(self.wake_write, 'x')
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def pending(self):
+        """Number of requests posted and not yet called back.
+
+        """
+        return self.in_flight
+
+    def _dispatch(self):
+        self.lock.acquire()
+        try:
+            self.waiting.extend(self.posted)
+            self.posted = []
+        finally:
+            self.lock.release()
+        now = time.time()
+        while self.waiting:
+            conn = None
+            while self.idle:
+                conn = self.idle.pop()
+                if now - conn.used < self.idle_timeout:
+                    break
+                conn.close()
+                conn = None
+            if conn is None:
+                if len(self.connections) >= self.max_connections:
+                    return
+                try:
+                    conn = _Connection(self)
+                except socket.error:
+                    log.exception("Unable to connect to %s" % self.host)
+                    self._callback(self.waiting.pop(0), None, None)
+                    continue
+                self.connections.add(conn)
+            conn.start(self.waiting.pop(0))
+
+    def _callback(self, request, status, content):
+        try:
+            request.callback(status, content)
+        except Exception:
+            log.exception("Unexpected exception")
+        self.lock.acquire()
+        try:
+            self.in_flight -= 1
+        finally:
+            self.lock.release()
+
+    def _finished(self, conn, request, status, content):
+        if conn.connected:
+            conn.used = time.time()
+            self.idle.append(conn)
+        self._callback(request, status, content)
+
+    def _failed(self, conn, request):
+        if request is None:
+            return
+        request.attempts -= 1
+        if request.attempts > 0 and conn.received == 0:
+            log.debug("Reconnecting to %s" % self.host)
+            self.waiting.insert(0, request)
+        else:
+            self._callback(request, None, None)
+
+    def _closed(self, conn):
+        self.connections.discard(conn)
+        if conn in self.idle:
+            self.idle.remove(conn)
+
+    def _run(self):
+        log.info("Started HTTP event loop for %s" % self.host)
+        while not self.stopping or self.in_flight:
+            self._dispatch()
+            asyncore.loop(1.0, True, self.map, 1)
+        for conn in list(self.connections):
+            conn.close()
+        self.waker.close()
+        os.close(self.wake_write)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='HTTPLoop')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the event loop once every posted request is done.
+
+        """
+        self.stopping = True
+        self._wake()
+        if self.thread is not None:
+            while self.thread.isAlive():
+                self.thread.join(1.0)
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+import logging, metrics, threading, time
+from asynchttp import AsyncHTTPClient
+from executor import BoundedExecutor
+from serialize import add_chunks
+from solr import SolrException
+from updater import ACCEPTED, REJECTED, UNAVAILABLE, SolrUpdater
+
+log = logging.getLogger(__name__)
+
+__all__ = ['AsyncSolrUpdater']
+
+
+class AsyncSolrUpdater(SolrUpdater):
+    """SolrUpdater sending add requests as non-blocking I/O.
+
+    Messages are decoded and serialized in the thread consuming from AMQP,
+    and their add requests go out on an AsyncHTTPClient, up to
+    max_in_flight at a time; consumption pauses beyond that. A message is
+    acknowledged once Solr accepted it, and spooled if Solr rejected it.
+    Adds Solr failed to apply are retried by a thread of their own (see
+    SolrUpdater._retrying), and stay in flight meanwhile. Other messages
+    (deletions) wait for the adds in flight, then are applied in the
+    consuming thread, so they keep their order with the adds around them.
+
+    Every message is a request of its own: buffer_docs is ignored.
+    """
+
+    def __init__(self, amqp, solr_uri, max_in_flight=200, **kwargs):
+        """Constructor.
+
+        :param max_in_flight: Max add requests sent to Solr and not yet
+                              answered
+        :param kwargs: Parameters of SolrUpdater
+        """
+        SolrUpdater.__init__(self, amqp, solr_uri, **kwargs)
+        self.max_in_flight = max(max_in_flight, 1)
+        self.http = None
+        self.retrier = None
+        self.in_flight = 0
+        self.in_flight_cond = threading.Condition()
+
+    def _start_workers(self, workers, queue_size):
+        self.http = AsyncHTTPClient(self.solr_uri, self.max_in_flight)
+        self.http.start()
+        # Never blocks the event loop: there are at most max_in_flight adds
+        self.retrier = BoundedExecutor(1, self.max_in_flight, 'Retry')
+        self.retrier.start()
+        metrics.gauge('update.in_flight', lambda: self.in_flight)
+        metrics.gauge('update.solr_down', lambda: int(self.breaker.is_open()))
+
+    def _drain(self):
+        if self.http is not None:
+            self._wait_in_flight(0)
+            self.http.stop()
+            self.retrier.shutdown()
+
+    def _wait_in_flight(self, limit):
+        """Wait until at most limit add requests are in flight.
+
+        """
+        start = time.time()
+        self.in_flight_cond.acquire()
+        try:
+            while self.in_flight > limit:
+                # With a timeout, so signal handlers get to run
+                self.in_flight_cond.wait(1.0)
+        finally:
+            self.in_flight_cond.release()
+        metrics.observe('update.queue_wait', time.time() - start)
+
+    def _on_receive(self, msg):
+        log.debug("Received update request")
+        metrics.incr('amqp.consumed')
+        metrics.incr('amqp.consumed_bytes', len(msg.body))
+        self._track(msg)
+        self._wait_for_solr()
+        try:
+            updates = self._decode(msg)
+        except Exception:
+            log.exception("Malformed update request")
+            self._conclude([msg], [self._mark({}, msg)], REJECTED,
+                           'malformed message')
+            return
+
+        if updates.get('type') == 'updated':
+            self._post_add(updates, msg)
+            return
+        self._wait_in_flight(0)
+        outcome, reason = self._retrying(
+            lambda solr: self._apply(solr, updates))
+        self._conclude([msg], [self._mark(updates, msg)], outcome, reason)
+
+    def _post_add(self, updates, msg):
+        """Send the documents of an 'updated' message to Solr.
+
+        """
+        docs = updates['data']
+        solr = self._solr()
+        if self.update_format == 'json':
+            url, headers = self.solr_uri + '/update/json', solr.jsonheaders
+        else:
+            url, headers = self.solr_uri + '/update', solr.xmlheaders
+        body = ''.join(add_chunks(docs, self.update_format))
+        mark = self._mark(updates, msg)
+        self._wait_in_flight(self.max_in_flight - 1)
+        self.in_flight_cond.acquire()
+        try:
+            self.in_flight += 1
+        finally:
+            self.in_flight_cond.release()
+        log.debug("Sending %d document(s) to Solr" % len(docs))
+        start = time.time()
+        callback = lambda status, content: \
+            self._added(solr, updates, msg, mark, start, status, content)
+        self.http.post(url, body, headers, callback)
+
+    def _added(self, solr, updates, msg, mark, start, status, content):
+        """Settle a message once Solr answered its add request.
+
+        Called in the thread of the event loop.
+        """
+        docs = updates['data']
+        retrying = False
+        try:
+            outcome, reason = ACCEPTED, None
+            if status is None:
+                log.error("HTTP error")
+                outcome, reason = UNAVAILABLE, 'no answer from Solr'
+            elif status != 200:
+                log.error("HTTP request returned code %d" % status)
+                outcome, reason = UNAVAILABLE, 'HTTP code %d' % status
+                if 400 <= status < 500:
+                    outcome = REJECTED
+            else:
+                try:
+                    solr.checkUpdate(content)
+                except SolrException, e:
+                    log.error("Solr rejected update: %s" % e)
+                    outcome, reason = REJECTED, str(e)
+                except Exception, e:
+                    log.exception("Unexpected exception")
+                    outcome = REJECTED
+                    reason = 'unexpected exception: %r' % e
+            if outcome != ACCEPTED:
+                metrics.incr('solr.update_errors')
+            if outcome == UNAVAILABLE:
+                self.breaker.failure()
+                if not self.stopping:
+                    self.retrier.submit(self._retry_add, updates, msg, mark)
+                    retrying = True
+                    return
+            else:
+                self.breaker.success()
+            if outcome == REJECTED and not self.stopping:
+                # Spooling may wait for the disk (see _dead_letter)
+                self.retrier.submit(self._reject, msg, mark, reason)
+                retrying = True
+                return
+            if outcome == ACCEPTED:
+                metrics.observe('solr.update', time.time() - start)
+                metrics.incr('update.docs', len(docs))
+                if self.commits is not None:
+                    self.commits.mark_dirty(len(docs), self._doc_dbs(docs))
+            self._conclude([msg], [mark], outcome, reason)
+        finally:
+            if not retrying:
+                self._done()
+
+    def _retry_add(self, updates, msg, mark):
+        """Retry an add request Solr failed to apply, then settle it.
+
+        """
+        try:
+            outcome, reason = self._retrying(
+                lambda solr: self._apply(solr, updates))
+            self._conclude([msg], [mark], outcome, reason)
+        finally:
+            self._done()
+
+    def _reject(self, msg, mark, reason):
+        """Settle a message Solr rejected.
+
+        """
+        try:
+            self._conclude([msg], [mark], REJECTED, reason)
+        finally:
+            self._done()
+
+    def _done(self):
+        """Count an add request out of flight.
+
+        """
+        self.in_flight_cond.acquire()
+        try:
+            self.in_flight -= 1
+            self.in_flight_cond.notifyAll()
+        finally:
+            self.in_flight_cond.release()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+import logging, threading
+
+log = logging.getLogger(__name__)
+
+__all__ = ['BatchSizer']
+
+
+class BatchSizer(object):
+    """Number of changes to read per page of a database.
+
+    After every page, the size it would have taken to produce
+    target_bytes of messages, and the size it would have taken to process
+    the page in target_latency seconds, are estimated from what the page
+    cost per document. The smaller estimate becomes the next size, except
+    that a size at most doubles from one page to the next, so one page of
+    small documents does not blow up the next. Sizes shrink right away,
+    as a page of large documents is the costly case.
+    """
+
+    def __init__(self, size=1000, min_size=1000, max_size=1000,
+                 target_bytes=1024 * 1024, target_latency=2.0):
+        """Constructor.
+
+        :param size: Size of the first page
+        :param min_size: Smallest size
+        :param max_size: Largest size (min_size = max_size disables
+                         adapting)
+        :param target_bytes: Size in bytes of the messages of a page to aim
+                             at, 0 for no target
+        :param target_latency: Seconds to aim at for reading, fetching and
+                               serializing a page, 0 for no target
+        """
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_bytes = target_bytes
+        self.target_latency = target_latency
+        self.size = self._bound(size)
+        self.lock = threading.Lock()
+
+    def _bound(self, size):
+        return int(max(self.min_size, min(self.max_size, size)))
+
+    def observe(self, docs, seconds, size_bytes):
+        """Adapt the size to the cost of a page.
+
+        :param docs: Changes in the page
+        :param seconds: Time it took to process the page
+        :param size_bytes: Total size of its messages
+        :return: The new size
+        """
+        self.lock.acquire()
+        try:
+            if docs <= 0 or self.min_size >= self.max_size:
+                return self.size
+            ideal = self.max_size
+            if self.target_bytes > 0 and size_bytes > 0:
+                ideal = min(ideal, self.target_bytes * docs / float(size_bytes))
+            if self.target_latency > 0 and seconds > 0:
+                ideal = min(ideal, self.target_latency * docs / seconds)
+            size = self._bound(min(ideal, self.size * 2))
+            if size != self.size:
+                log.debug("Page size %d -> %d (%d changes, %d bytes in %.3fs)"
+                          % (self.size, size, docs, size_bytes, seconds))
+                self.size = size
+            return size
+        finally:
+            self.lock.release()
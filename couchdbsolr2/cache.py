@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+"""Caching of search results and invalidation on commit.
+
+couchdb-solr2-update and couchdb-solr2-query are separate processes, so
+the updater records its commits as stamp files, one per database, whose
+modification time is the time of the last commit that changed it. The
+query cache compares a cached result with the stamp of its database and
+drops results that were fetched before the last commit.
+"""
+
+import errno, logging, os, threading, time, urllib
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+log = logging.getLogger(__name__)
+
+__all__ = ['ALL_DATABASES', 'CommitStamps', 'QueryCache']
+
+# Stamp touched when the database of a change is not known. CouchDB
+# database names start with a letter, so this never names a database.
+ALL_DATABASES = '_all'
+
+
+class CommitStamps(object):
+    """Commit times of databases, kept as stamp files in a directory.
+
+    """
+
+    def __init__(self, directory):
+        """Constructor.
+
+        :param directory: Directory holding the stamp files, created if
+                          it does not exist
+        """
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, db_name):
+        return os.path.join(self.directory, urllib.quote(db_name, ''))
+
+    def touch(self, db_names):
+        """Record that changes to databases were committed.
+
+        """
+        for db_name in db_names:
+            path = self._path(db_name)
+            try:
+                file(path, 'a').close()
+                os.utime(path, None)
+            except EnvironmentError:
+                log.exception("Unable to update commit stamp '%s'" % path)
+
+    def committed(self, db_name):
+        """Time of the last commit that changed a database.
+
+        :return: Seconds since the epoch, 0 if no commit was recorded
+        """
+        last = 0
+        for name in (db_name, ALL_DATABASES):
+            try:
+                last = max(last, os.stat(self._path(name)).st_mtime)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return last
+
+
+class QueryCache(object):
+    """Thread-safe LRU cache of search results with a size limit in bytes.
+
+    Results are cached per database, under the parameters sent to Solr.
+    An entry is dropped when it is older than ttl seconds, when it falls
+    off the least recently used end of the cache, or when its database is
+    committed to after the entry was fetched. Stamps are checked at most
+    once per stamp_interval seconds and database.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=60, stamps=None,
+                 stamp_interval=1.0):
+        """Constructor.
+
+        :param max_bytes: Max total size of cached results
+        :param ttl: Max seconds a result is served from the cache, 0 for
+                    no limit
+        :param stamps: CommitStamps invalidating results, or None
+        :param stamp_interval: Min seconds between checks of the stamp of
+                               a database
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stamps = stamps
+        self.stamp_interval = stamp_interval
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.by_db = {}
+        # Circular doubly linked list of entries, most recently used
+        # first. Entries are [prev, next, key, db_name, value, size,
+        # fetched].
+        self.root = root = []
+        root[:] = [root, root, None, None, None, 0, 0]
+        self.size = 0
+        self.checked = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def key(self, params):
+        """Normalize query parameters into a cache key.
+
+        """
+        return json.dumps(params, sort_keys=True)
+
+    def _unlink(self, entry):
+        prev, next = entry[0], entry[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _link(self, entry):
+        root = self.root
+        first = root[1]
+        entry[0], entry[1] = root, first
+        first[0] = entry
+        root[1] = entry
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        key, db_name = entry[2], entry[3]
+        del self.entries[key]
+        keys = self.by_db[db_name]
+        keys.discard(key)
+        if not keys:
+            del self.by_db[db_name]
+        self.size -= entry[5]
+
+    def _committed(self, db_name, now):
+        """Commit time of a database, rereading its stamp if due.
+
+        """
+        checked = self.checked.get(db_name)
+        if checked is None or now - checked[0] >= self.stamp_interval:
+            checked = (now, self.stamps.committed(db_name))
+            self.checked[db_name] = checked
+        return checked[1]
+
+    def get(self, key):
+        """Look up a cached result.
+
+        :return: The result, or None if it is not cached or stale
+        """
+        now = time.time()
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is not None:
+                fetched = entry[6]
+                if self.ttl > 0 and now - fetched >= self.ttl:
+                    self._remove(entry)
+                    entry = None
+                elif self.stamps is not None and \
+                        self._committed(entry[3], now) >= fetched:
+                    self._invalidate(entry[3])
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._unlink(entry)
+            self._link(entry)
+            return entry[4]
+        finally:
+            self.lock.release()
+
+    def put(self, key, db_name, value, fetched):
+        """Cache a result.
+
+        :param key: Key returned by key()
+        :param db_name: Database that was searched
+        :param value: Result, a string
+        :param fetched: Time the request to Solr was started
+        """
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self._remove(entry)
+            entry = [None, None, key, db_name, value, size, fetched]
+            self._link(entry)
+            self.entries[key] = entry
+            self.by_db.setdefault(db_name, set()).add(key)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(self.root[0])
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def _invalidate(self, db_name):
+        for key in list(self.by_db.get(db_name, ())):
+            self._remove(self.entries[key])
+            self.invalidations += 1
+
+    def invalidate(self, db_name):
+        """Drop all cached results of a database.
+
+        """
+        self.lock.acquire()
+        try:
+            self._invalidate(db_name)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        """Return counters of the cache as a dictionary.
+
+        """
+        self.lock.acquire()
+        try:
+            return {
+                'entries' : len(self.entries),
+                'bytes' : self.size,
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'evictions' : self.evictions,
+                'invalidations' : self.invalidations
+            }
+        finally:
+            self.lock.release()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+import logging, os, threading
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+log = logging.getLogger(__name__)
+
+__all__ = ['CheckpointStore']
+
+
+class CheckpointStore(object):
+    """Checkpoints kept in memory and persisted to a JSON file.
+
+    The file is read once, when the store is created. Every flush writes
+    a temporary file next to it, syncs it to disk and renames it over the
+    previous one, so a crash leaves either the old or the new checkpoints
+    on disk but never a truncated file.
+    """
+
+    def __init__(self, path):
+        """Constructor.
+
+        :param path: Path to checkpoint file
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.checkpoints = self._load()
+        self.dirty = False
+
+    def _load(self):
+        if os.path.exists(self.path):
+            try:
+                return json.load(file(self.path))
+            except Exception:
+                log.exception("Error reading checkpoint file '%s'" % self.path)
+        return {}
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            return self.checkpoints.get(key, default)
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        """Return a copy of all checkpoints.
+
+        """
+        self.lock.acquire()
+        try:
+            return dict(self.checkpoints)
+        finally:
+            self.lock.release()
+
+    def set(self, key, value, flush=True):
+        """Record a checkpoint.
+
+        :param key: Checkpoint name, e.g. a database name
+        :param value: JSON serializable checkpoint value
+        :param flush: Whether to persist the checkpoints right away
+        """
+        self.lock.acquire()
+        try:
+            if self.checkpoints.get(key) != value:
+                self.checkpoints[key] = value
+                self.dirty = True
+            if flush:
+                self._flush()
+        finally:
+            self.lock.release()
+
+    def delete(self, key, flush=True):
+        self.lock.acquire()
+        try:
+            if self.checkpoints.has_key(key):
+                del self.checkpoints[key]
+                self.dirty = True
+            if flush:
+                self._flush()
+        finally:
+            self.lock.release()
+
+    def replace(self, checkpoints, flush=True):
+        """Replace all checkpoints.
+
+        """
+        self.lock.acquire()
+        try:
+            self.checkpoints = dict(checkpoints)
+            self.dirty = True
+            if flush:
+                self._flush()
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            self._flush()
+        finally:
+            self.lock.release()
+
+    def _flush(self):
+        if not self.dirty:
+            return
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        fp = file(tmp, 'w')
+        try:
+            json.dump(self.checkpoints, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        finally:
+            fp.close()
+        os.rename(tmp, self.path)
+        self.dirty = False
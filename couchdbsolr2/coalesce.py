@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+import logging, threading, time, Queue
+from scheduler import fold_notification
+
+log = logging.getLogger(__name__)
+
+__all__ = ['NotificationCoalescer']
+
+_END = object()
+
+
+class NotificationCoalescer(object):
+    """Group bursts of update notifications.
+
+    CouchDB sends a notification for every write. Iterating over a
+    NotificationCoalescer yields lists of (db, type) pairs instead, where
+    every notification received during a burst appears folded per database
+    (see fold_notification). A burst ends when no notification arrived for
+    window seconds, when max_count notifications were gathered, or at the
+    latest max_delay seconds after its first notification.
+    """
+
+    def __init__(self, notifications, window=0.5, max_count=1000,
+                 max_delay=5.0):
+        """Constructor.
+
+        :param notifications: Iterable of (db, type) pairs. It is consumed
+                              from a separate thread.
+        :param window: Seconds of quiet that end a burst
+        :param max_count: Max notifications gathered into one burst
+        :param max_delay: Max seconds a notification is held back
+        """
+        self.notifications = notifications
+        self.window = window
+        self.max_count = max_count
+        self.max_delay = max_delay
+        self.queue = Queue.Queue()
+
+    def _read(self):
+        try:
+            for notify in self.notifications:
+                self.queue.put(notify)
+        except Exception:
+            log.exception("Problem reading update notifications")
+        self.queue.put(_END)
+
+    def __iter__(self):
+        reader = threading.Thread(target=self._read)
+        reader.setDaemon(True)
+        reader.start()
+
+        notify = self.queue.get()
+        while notify is not _END:
+            deadline = time.time() + self.max_delay
+            order = []
+            pending = {}
+            count = 0
+            while notify is not _END:
+                db, taipu = notify
+                if not pending.has_key(db):
+                    order.append(db)
+                    pending[db] = []
+                fold_notification(pending[db], taipu)
+                count += 1
+                timeout = min(self.window, deadline - time.time())
+                if count >= self.max_count or timeout <= 0:
+                    notify = None
+                    break
+                try:
+                    notify = self.queue.get(True, timeout)
+                except Queue.Empty:
+                    notify = None
+                    break
+            log.debug("Coalesced %d notification(s) for %d database(s)"
+                      % (count, len(order)))
+            yield [(db, taipu) for db in order for taipu in pending[db]]
+            if notify is None:
+                notify = self.queue.get()
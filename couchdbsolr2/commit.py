@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+import logging, threading, time
+
+log = logging.getLogger(__name__)
+
+__all__ = ['CommitScheduler', 'parse_window']
+
+
+def parse_window(window):
+    """Parse a daily time window such as '02:00-04:30'.
+
+    :return: Tuple of start and end minute of the day, or None if window
+             is empty. The window wraps around midnight if start > end.
+    """
+    if not window or not window.strip():
+        return None
+    minutes = []
+    for part in window.split('-'):
+        hours, mins = part.strip().split(':')
+        minutes.append(int(hours) * 60 + int(mins))
+    if len(minutes) != 2:
+        raise ValueError("Invalid time window: '%s'" % window)
+    return tuple(minutes)
+
+
+class CommitScheduler(object):
+    """Coalesce Solr commits.
+
+    Updates only mark the index dirty. A background thread commits once
+    interval seconds have passed since the index first became dirty, or
+    as soon as max_docs documents were changed, whichever comes first.
+    If an optimize window is given, the index is also optimized once each
+    time the window is entered, provided it changed since the last
+    optimize.
+    """
+
+    def __init__(self, solr, interval=60, max_docs=10000, wait=True,
+                 optimize_window=None, on_commit=None):
+        """Constructor.
+
+        :param solr: Callable returning a SolrConnection
+        :param interval: Max seconds between a change and its commit
+        :param max_docs: Changed documents that trigger a commit right away
+        :param wait: Whether commits wait for flush and a new searcher
+        :param optimize_window: (start, end) minutes of the day within which
+                                to optimize, see parse_window
+        :param on_commit: Callable taking the names of the databases whose
+                          changes were just committed, or None
+        """
+        self.solr = solr
+        self.interval = interval
+        self.max_docs = max_docs
+        self.wait = wait
+        self.optimize_window = optimize_window
+        self.on_commit = on_commit
+        self.cond = threading.Condition()
+        self.pending = 0
+        self.dbs = set()
+        self.dirty_since = None
+        self.changed = False
+        self.optimized = False
+        self.optimize_after = 0
+        self.stopping = False
+        self.thread = None
+
+    def mark_dirty(self, docs=1, dbs=()):
+        """Record that documents were added to or deleted from the index.
+
+        :param docs: Number of changed documents
+        :param dbs: Names of the databases of the documents
+        """
+        self.cond.acquire()
+        try:
+            self.pending += docs
+            self.dbs.update(dbs)
+            self.changed = True
+            if self.dirty_since is None:
+                self.dirty_since = time.time()
+            if self.pending >= self.max_docs:
+                self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def _due(self):
+        if self.dirty_since is None:
+            return False
+        return self.stopping or self.pending >= self.max_docs \
+            or time.time() - self.dirty_since >= self.interval
+
+    def _take(self):
+        """Wait until a commit is due and claim the pending changes.
+
+        :return: Tuple of the number of changed documents to commit, 0 if
+                 none is due, and the names of their databases
+        """
+        self.cond.acquire()
+        try:
+            if not self._due() and not self.stopping:
+                self.cond.wait(min(1.0, self.interval))
+            if not self._due():
+                return 0, ()
+            docs, dbs = self.pending, self.dbs
+            self.pending = 0
+            self.dbs = set()
+            self.dirty_since = None
+            return docs, dbs
+        finally:
+            self.cond.release()
+
+    def _commit(self, docs, dbs, optimize=False):
+        log.info("Committing %d change(s)%s"
+                 % (docs, optimize and ' and optimizing' or ''))
+        try:
+            ok = self.solr().commit(waitFlush=self.wait,
+                                    waitSearcher=self.wait,
+                                    optimize=optimize) is not None
+        except Exception:
+            log.exception("Unexpected exception")
+            ok = False
+        if not ok:
+            log.error("Commit failed, retrying later")
+            self.mark_dirty(docs, dbs)
+        elif dbs and self.on_commit is not None:
+            self.on_commit(dbs)
+        return ok
+
+    def _in_window(self):
+        start, end = self.optimize_window
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        if start <= end:
+            return start <= minute < end
+        return minute >= start or minute < end
+
+    def _optimize_due(self):
+        if self.optimize_window is None:
+            return False
+        if not self._in_window():
+            self.optimized = False
+            return False
+        return not self.optimized and self.changed and \
+            time.time() >= self.optimize_after
+
+    def _run(self):
+        log.info("Started thread to commit changes")
+        while True:
+            docs, dbs = self._take()
+            if self._optimize_due():
+                self.changed = False
+                if self._commit(docs, dbs, True):
+                    self.optimized = True
+                else:
+                    # Tried again within the window, after interval
+                    self.changed = True
+                    self.optimize_after = time.time() + self.interval
+            elif docs:
+                self._commit(docs, dbs)
+            if self.stopping:
+                return
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """Commit pending changes and stop the commit thread.
+
+        """
+        self.cond.acquire()
+        try:
+            self.stopping = True
+            self.cond.notify()
+        finally:
+            self.cond.release()
+        if self.thread is not None:
+            self.thread.join()
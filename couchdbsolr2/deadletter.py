@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+"""Spool file of update messages that could not be applied to Solr.
+
+The spool holds one JSON object per line: the time the message was
+given up on, the reason, its AMQP content type and encoding, and its
+body in base64. Lines are appended with a single write each and synced
+to disk, and the file is reopened for every append, so a replay can move
+the spool aside while the updater keeps appending to a new one.
+"""
+
+import base64, errno, logging, os, re, threading, time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+log = logging.getLogger(__name__)
+
+__all__ = ['DeadLetterSpool']
+
+
+class DeadLetterSpool(object):
+
+    def __init__(self, path):
+        """Constructor.
+
+        :param path: Path to spool file
+        """
+        self.path = path
+        self.lock = threading.Lock()
+
+    def check(self):
+        """Make sure the spool can be written, creating it if missing.
+
+        :raise EnvironmentError: If it cannot
+        """
+        os.close(os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0644))
+
+    def _line(self, body, properties, reason):
+        return json.dumps({
+            'time' : time.time(),
+            'reason' : reason,
+            'content_type' : properties.get('content_type'),
+            'content_encoding' : properties.get('content_encoding'),
+            'body' : base64.b64encode(body)
+        }) + '\n'
+
+    def _append(self, path, lines):
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, ''.join(lines))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def append(self, messages, reason):
+        """Spool messages.
+
+        :param messages: List of (body, AMQP message properties) pairs
+        :param reason: Why the messages are given up on
+        """
+        lines = [self._line(body, properties, reason)
+                 for body, properties in messages]
+        self.lock.acquire()
+        try:
+            self._append(self.path, lines)
+        finally:
+            self.lock.release()
+
+    def _read(self, path):
+        """Yield (body, properties, entry) for each message of a file.
+
+        """
+        fp = file(path)
+        try:
+            for number, line in enumerate(fp):
+                try:
+                    entry = json.loads(line)
+                    body = base64.b64decode(entry['body'])
+                except (ValueError, KeyError, TypeError):
+                    log.error("Skipping malformed line %d of '%s'"
+                              % (number + 1, path))
+                    continue
+                properties = {'content_type' : entry.get('content_type')}
+                if entry.get('content_encoding'):
+                    properties['content_encoding'] = entry['content_encoding']
+                yield body, properties, entry
+        finally:
+            fp.close()
+
+    def _leftovers(self):
+        """Files moved aside by replays that did not finish, oldest first.
+
+        Those of replays still running are left to them.
+        """
+        directory = os.path.dirname(self.path) or '.'
+        pattern = re.compile(re.escape(os.path.basename(self.path)) +
+                             r'\.(\d+)\.replay$')
+        leftovers = []
+        for name in os.listdir(directory):
+            match = pattern.match(name)
+            if match is None or _running(int(match.group(1))):
+                continue
+            path = os.path.join(directory, name)
+            leftovers.append((os.path.getmtime(path), path))
+        leftovers.sort()
+        return [path for mtime, path in leftovers]
+
+    def replay(self, apply):
+        """Hand every spooled message to apply, keeping those that fail.
+
+        The spool is moved aside first, after the files of replays that
+        were interrupted. Messages apply fails on are appended back to the
+        spool, after any spooled in the meantime.
+
+        :param apply: Callable taking message body and properties, and
+                      returning a reason if the message still fails, or
+                      None
+        :return: Tuple of numbers of messages replayed and kept
+        """
+        paths = self._leftovers()
+        replaying = '%s.%d.replay' % (self.path, os.getpid())
+        try:
+            os.rename(self.path, replaying)
+            paths.append(replaying)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        replayed = kept = 0
+        for path in paths:
+            log.info("Replaying '%s'" % path)
+            for body, properties, entry in self._read(path):
+                reason = apply(body, properties)
+                if reason is None:
+                    replayed += 1
+                else:
+                    kept += 1
+                    self.append([(body, properties)], reason)
+            os.unlink(path)
+        return replayed, kept
+
+
+def _running(pid):
+    """Whether a process is running.
+
+    """
+    if pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
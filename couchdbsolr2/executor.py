@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+import logging, threading, time, Queue
+
+log = logging.getLogger(__name__)
+
+__all__ = ['BoundedExecutor', 'ExecutorShutdown']
+
+_STOP = object()
+
+
+class ExecutorShutdown(Exception):
+    """Raised when work is submitted to an executor that was shut down.
+
+    """
+
+
+class BoundedExecutor(object):
+    """Worker threads running calls taken from a bounded queue.
+
+    submit blocks while queue_size calls are waiting to be run, so whoever
+    produces work faster than the workers get through it is held back
+    instead of piling it up in memory. Workers block on the queue, there
+    is no polling.
+    """
+
+    def __init__(self, workers=10, queue_size=0, name='Worker'):
+        """Constructor.
+
+        :param workers: Number of worker threads
+        :param queue_size: Max calls waiting for a worker, 0 for twice the
+                           number of workers
+        :param name: Prefix of the names of the worker threads
+        """
+        self.workers = max(workers, 1)
+        self.queue_size = queue_size > 0 and queue_size or 2 * self.workers
+        self.name = name
+        self.queue = Queue.Queue(self.queue_size)
+        self.threads = []
+        self.lock = threading.Lock()
+        self.closed = False
+        self.active = 0
+
+    def start(self):
+        for i in xrange(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name='%s-%d' % (self.name, i + 1))
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _put(self, item):
+        # Without a timeout, a blocked put cannot be interrupted by signal
+        # handlers in the main thread.
+        while True:
+            try:
+                self.queue.put(item, True, 1.0)
+                return
+            except Queue.Full:
+                pass
+
+    def submit(self, func, *args):
+        """Have a worker call func(*args), waiting for room in the queue.
+
+        Exceptions raised by func are logged.
+
+        :return: Seconds spent waiting for room in the queue
+        :raise ExecutorShutdown: if shutdown was called
+        """
+        if self.closed:
+            raise ExecutorShutdown, "Executor '%s' is shut down" % self.name
+        start = time.time()
+        self._put((func, args))
+        return time.time() - start
+
+    def pending(self):
+        """Number of calls waiting for a worker or being run.
+
+        """
+        return self.queue.qsize() + self.active
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+            func, args = item
+            self.lock.acquire()
+            self.active += 1
+            self.lock.release()
+            try:
+                func(*args)
+            except Exception:
+                log.exception("Unexpected exception")
+            self.lock.acquire()
+            self.active -= 1
+            self.lock.release()
+
+    def shutdown(self, wait=True):
+        """Stop accepting work, and stop the workers once they ran all of
+        what was submitted.
+
+        :param wait: Whether to wait for the workers to finish
+        """
+        self.lock.acquire()
+        try:
+            if self.closed:
+                return
+            self.closed = True
+        finally:
+            self.lock.release()
+        for thread in self.threads:
+            self._put(_STOP)
+        if wait:
+            for thread in self.threads:
+                while thread.isAlive():
+                    thread.join(1.0)
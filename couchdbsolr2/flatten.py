@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+import logging
+
+log = logging.getLogger(__name__)
+
+__all__ = ['flatten']
+
+_LEAF, _LIST, _DICT, _SKIP = range(4)
+
+_kinds = {
+    str : _LEAF,
+    unicode : _LEAF,
+    int : _LEAF,
+    long : _LEAF,
+    float : _LEAF,
+    bool : _LEAF,
+    list : _LIST,
+    dict : _DICT,
+    type(None) : _SKIP
+}
+
+_index_suffixes = ['/$%d' % i for i in xrange(1024)]
+
+
+def _kind(obj):
+    """Classify instances of subclasses of the types in _kinds.
+
+    """
+    if isinstance(obj, (basestring, int, long, float)):
+        return _LEAF
+    elif isinstance(obj, list):
+        return _LIST
+    elif isinstance(obj, dict):
+        return _DICT
+
+
+def _list_paths(path, count):
+    if not path:
+        return ['$%d' % i for i in xrange(count)]
+    if count <= len(_index_suffixes):
+        return [path + suffix for suffix in _index_suffixes[:count]]
+    return [path + suffix for suffix in _index_suffixes] + \
+        ['%s/$%d' % (path, i) for i in xrange(len(_index_suffixes), count)]
+
+
+def flatten(doc, fields, max_depth=64, max_fields=100000):
+    """Flatten fields of a document into (path, value) pairs.
+
+    Nested objects and arrays are walked depth first. The path of a value
+    joins the keys leading to it with '/', array elements being named
+    '$index'. None values are left out.
+
+    :param doc: Document
+    :param fields: Names of the top-level fields to flatten
+    :param max_depth: Objects and arrays nested deeper than this are left
+                      out
+    :param max_fields: Max pairs returned, further values are left out
+    :return: List of (path, value) pairs
+    """
+    pairs = []
+    stack = [(field, doc[field], 0) for field in fields if doc.has_key(field)]
+    stack.reverse()
+    while stack:
+        path, obj, depth = stack.pop()
+        kind = _kinds.get(type(obj))
+        if kind is None:
+            kind = _kind(obj)
+
+        if kind == _LEAF:
+            if len(pairs) >= max_fields:
+                log.warning("Document has more than %d fields, ignoring the "
+                            "rest" % max_fields)
+                break
+            pairs.append((path, obj))
+        elif kind == _DICT or kind == _LIST:
+            if depth >= max_depth:
+                log.warning("Ignoring '%s', nested more than %d levels deep"
+                            % (path, max_depth))
+                continue
+            depth += 1
+            if kind == _DICT:
+                prefix = path and path + '/' or ''
+                children = [(prefix + key, value, depth)
+                            for key, value in obj.items()]
+            else:
+                children = [(child_path, obj[i], depth) for i, child_path
+                            in enumerate(_list_paths(path, len(obj)))]
+            children.reverse()
+            stack.extend(children)
+        elif kind != _SKIP:
+            log.error("Unhandled field type: " + str(type(obj)))
+    return pairs
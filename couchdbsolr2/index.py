@@ -7,18 +7,34 @@
 # http://www.opensource.org/licenses/mit-license.php
 # for details.
 
-import logging, signal, sys
+import logging, metrics, signal, sys
 from announcer import UpdateAnnouncer
+from coalesce import NotificationCoalescer
 from lineprotocol import LineProtocol
+from message import formats
 from optparse import OptionParser
+from scheduler import DatabaseScheduler
+from spool import SpoolLocked
 from util import *
 from version import version
 
 log = logging.getLogger(__name__)
 
 
-def eval_loop(updater):
-    protocol = LineProtocol()
+def dispatch(updater, db, taipu):
+    try:
+        if taipu == 'updated':
+            updater.update_index(db)
+        elif taipu == 'deleted':
+            updater.delete_database(db)
+    except Exception:
+        log.exception("Uncaught exception")
+
+
+def notifications(protocol):
+    """Yield (db, type) pairs of well-formed update notifications.
+
+    """
     for notify in protocol.input():
         log.debug("Received update notification: " + str(notify))
 
@@ -29,16 +45,35 @@ def eval_loop(updater):
             log.exception("Expected keys 'db' and 'type' not found")
             continue
 
-        try:
-            if taipu == 'updated':
-                updater.update_index(db)
-            elif taipu == 'deleted':
-                updater.delete_database(db)
-            else:
-                log.error("Unknown update notification: %s" % taipu)
-        except Exception:
-            log.exception("Uncaught exception")
+        if taipu not in ('updated', 'deleted'):
+            log.error("Unknown update notification: %s" % taipu)
             continue
+        metrics.incr('index.notifications')
+        yield db, taipu
+
+
+def eval_loop(updater, scheduler=None, coalesce=None):
+    """Handle update notifications read from standard input.
+
+    :param updater: UpdateAnnouncer handling the notifications
+    :param scheduler: DatabaseScheduler to run them on, or None to handle
+                      each notification before reading the next one
+    :param coalesce: Keyword arguments of a NotificationCoalescer grouping
+                     bursts of notifications, or None to handle every
+                     notification as it arrives
+    """
+    if coalesce is not None:
+        bursts = NotificationCoalescer(notifications(LineProtocol()),
+                                       **coalesce)
+    else:
+        bursts = ([notify] for notify in notifications(LineProtocol()))
+
+    for burst in bursts:
+        for db, taipu in burst:
+            if scheduler is not None:
+                scheduler.submit(db, taipu)
+            else:
+                dispatch(updater, db, taipu)
 
 
 def validate_amqp(amqp):
@@ -50,14 +85,40 @@ def validate_amqp(amqp):
 def configure(config_file):
     defaults = {
         'index' : {
-            'seqid' : '.couchdb_seq_id'
+            'seqid' : '.couchdb_seq_id',
+            'batch_size' : '1000',
+            'min_batch' : '100',
+            'max_batch' : '10000',
+            'target_bytes' : '1048576',
+            'target_latency' : '2.0',
+            'max_message_docs' : '500',
+            'max_message_bytes' : '524288',
+            'bulk_fetch' : '100',
+            'pipeline_workers' : '0',
+            'workers' : '0',
+            'policy' : 'fifo',
+            'coalesce_window' : '0',
+            'coalesce_count' : '1000',
+            'coalesce_max_delay' : '5',
+            'message_format' : 'json',
+            'compress' : 'false',
+            'max_depth' : '64',
+            'max_fields' : '100000',
+            'processes' : '0',
+            'spool_dir' : '',
+            'spool_segment_bytes' : '16777216',
+            'reconnect_interval' : '5',
+            'connect_timeout' : '5',
+            'publish_timeout' : '30'
         },
         'couchdb' : {
             'uri' : 'http://127.0.0.1:5984/'
         },
         'log' : {
             'file' : 'couchdb-solr2-index.log',
-            'level' : 'info'
+            'level' : 'info',
+            'stats_file' : '',
+            'stats_interval' : '60'
         }
     }
     config = read_config(config_file, defaults)
@@ -67,6 +128,14 @@ def configure(config_file):
     if not validate_amqp(config.get('amqp')):
         print >> sys.stderr, 'AMQP configuration is invalid'
         return
+    if config['index']['message_format'] not in formats:
+        print >> sys.stderr, 'Message format must be one of: %s' \
+            % ', '.join(formats)
+        return
+    if config['index']['policy'] not in DatabaseScheduler.policies:
+        print >> sys.stderr, 'Scheduling policy must be one of: %s' \
+            % ', '.join(DatabaseScheduler.policies)
+        return
     return config
 
 
@@ -90,15 +159,60 @@ def main():
                         level=string2log_level(config['log']['level']),
                         format=log_format)
 
-    updater = UpdateAnnouncer(config['amqp'], config['couchdb']['uri'],
-                              config['index']['seqid'])
+    try:
+        updater = UpdateAnnouncer(config['amqp'], config['couchdb']['uri'],
+                                  config['index']['seqid'],
+                                  batch_size=int(config['index']['batch_size']),
+                                  bulk_fetch=int(config['index']['bulk_fetch']),
+                                  pipeline_workers=int(config['index']['pipeline_workers']),
+                                  message_format=config['index']['message_format'],
+                                  compress=config['index']['compress'] == 'true',
+                                  max_depth=int(config['index']['max_depth']),
+                                  max_fields=int(config['index']['max_fields']),
+                                  processes=int(config['index']['processes']),
+                                  min_batch=int(config['index']['min_batch']),
+                                  max_batch=int(config['index']['max_batch']),
+                                  target_bytes=int(config['index']['target_bytes']),
+                                  target_latency=float(config['index']['target_latency']),
+                                  max_message_docs=int(config['index']['max_message_docs']),
+                                  max_message_bytes=int(config['index']['max_message_bytes']),
+                                  spool_dir=config['index']['spool_dir'] or None,
+                                  spool_segment_bytes=int(config['index']['spool_segment_bytes']),
+                                  reconnect_interval=float(config['index']['reconnect_interval']),
+                                  connect_timeout=float(config['index']['connect_timeout']),
+                                  publish_timeout=float(config['index']['publish_timeout']))
+    except SpoolLocked, e:
+        print >> sys.stderr, e
+        return 2
     if updater.start_amqp() is False:
         print >> sys.stderr, "Problem connecting to AMQP broker"
         return 2
     signal.signal(signal.SIGTERM, lambda s, f: updater.shutdown())
+    # After UpdateAnnouncer forked any worker processes
+    metrics.start_reporting(config['log']['stats_file'] or None,
+                            float(config['log']['stats_interval']))
+
+    scheduler = None
+    workers = int(config['index']['workers'])
+    if workers > 0:
+        scheduler = DatabaseScheduler(lambda db, taipu: dispatch(updater, db, taipu),
+                                      workers, config['index']['policy'])
+        scheduler.start()
+        metrics.gauge('index.scheduler_pending',
+                      lambda: len(scheduler.pending))
+
+    coalesce = None
+    if float(config['index']['coalesce_window']) > 0:
+        coalesce = {
+            'window' : float(config['index']['coalesce_window']),
+            'max_count' : int(config['index']['coalesce_count']),
+            'max_delay' : float(config['index']['coalesce_max_delay'])
+        }
 
     log.info("Waiting for updates")
-    eval_loop(updater)
+    eval_loop(updater, scheduler, coalesce)
+    if scheduler is not None:
+        scheduler.shutdown()
     return 0
 
 
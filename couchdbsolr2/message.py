@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+"""Encoding of the messages sent from announcer to updater.
+
+Two formats exist, told apart by the AMQP content type:
+
+* 'json' (application/json): the original format. Each document of an
+  'updated' message is a list of single-key dictionaries.
+* 'compact' (COMPACT_TYPE): version 2. An 'updated' message carries a
+  table of the field paths used by its documents, and each document is a
+  flat array alternating an index into that table with a value.
+
+Either may be zlib compressed, which is flagged by the content encoding.
+Decoding accepts all of them, so updaters keep working with announcers
+that still send the original format.
+"""
+
+import zlib
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+__all__ = ['COMPACT_TYPE', 'decode', 'encode', 'formats']
+
+JSON_TYPE = 'application/json'
+COMPACT_TYPE = 'application/x-couchdb-solr2.v2+json'
+COMPRESSED = 'deflate'
+
+formats = ('json', 'compact')
+
+
+def _encode_json(updates):
+    if updates['type'] != 'updated':
+        return json.dumps(updates)
+    data = [[{path : value} for path, value in doc] for doc in updates['data']]
+    return json.dumps(dict(updates, data=data))
+
+
+def _encode_compact(updates):
+    if updates['type'] != 'updated':
+        return json.dumps(dict(updates, v=2), separators=(',', ':'))
+    fields = []
+    index = {}
+    docs = []
+    for doc in updates['data']:
+        row = []
+        for path, value in doc:
+            i = index.get(path)
+            if i is None:
+                i = index[path] = len(fields)
+                fields.append(path)
+            row.append(i)
+            row.append(value)
+        docs.append(row)
+    return json.dumps(dict(updates, v=2, fields=fields, data=docs),
+                      separators=(',', ':'))
+
+
+def encode(updates, format='json', compress=False):
+    """Serialize an update message.
+
+    :param updates: Message; documents of 'updated' messages are lists
+                    of (path, value) pairs
+    :param format: One of formats
+    :param compress: Whether to compress the message with zlib
+    :return: Tuple of message body and AMQP message properties
+    """
+    if format == 'compact':
+        body = _encode_compact(updates)
+        properties = {'content_type' : COMPACT_TYPE}
+    else:
+        body = _encode_json(updates)
+        properties = {'content_type' : JSON_TYPE}
+    if compress:
+        body = zlib.compress(body)
+        properties['content_encoding'] = COMPRESSED
+    return body, properties
+
+
+def decode(body, content_type=JSON_TYPE, content_encoding=None):
+    """Deserialize an update message in any format.
+
+    :return: Message; documents of 'updated' messages are lists of
+             (path, value) pairs
+    """
+    if content_encoding == COMPRESSED:
+        body = zlib.decompress(body)
+    updates = json.loads(body)
+    if updates.get('type') != 'updated':
+        return updates
+    if content_type == COMPACT_TYPE:
+        fields = updates.pop('fields')
+        updates['data'] = [[(fields[row[i]], row[i + 1])
+                            for i in xrange(0, len(row), 2)]
+                           for row in updates['data']]
+    else:
+        updates['data'] = [[item for field in doc for item in field.items()]
+                           for doc in updates['data']]
+    return updates
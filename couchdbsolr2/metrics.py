@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+"""Counters, gauges and latency histograms of a process.
+
+Instrumented code records into the registry of the process through the
+module functions, e.g.:
+
+    start = time.time()
+    ...
+    metrics.observe('solr.update', time.time() - start)
+    metrics.incr('update.docs', len(docs))
+
+Recording takes a lock and a few additions, so it stays on in
+production. start_reporting periodically writes everything recorded so
+far to a JSON stats file and logs a summary.
+"""
+
+import bisect, logging, os, threading, time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+log = logging.getLogger(__name__)
+
+__all__ = ['Histogram', 'Registry', 'StatsReporter', 'gauge', 'incr',
+           'observe', 'registry', 'start_reporting']
+
+# Upper bounds of histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+           1.0, 2.0, 5.0, 10.0, 30.0)
+
+
+class Histogram(object):
+    """Distribution of durations over fixed exponential buckets.
+
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of values.
+
+        """
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if i < len(BUCKETS):
+                    return min(BUCKETS[i], self.max)
+                return self.max
+        return self.max
+
+    def summary(self):
+        """Summary in milliseconds.
+
+        """
+        if not self.count:
+            return {'count' : 0}
+        ms = lambda seconds: round(seconds * 1000, 3)
+        return {
+            'count' : self.count,
+            'mean_ms' : ms(self.total / self.count),
+            'p50_ms' : ms(self.percentile(0.5)),
+            'p90_ms' : ms(self.percentile(0.9)),
+            'p99_ms' : ms(self.percentile(0.99)),
+            'max_ms' : ms(self.max)
+        }
+
+
+class Registry(object):
+    """Thread-safe store of named metrics.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def incr(self, name, n=1):
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + n
+        finally:
+            self.lock.release()
+
+    def gauge(self, name, value):
+        """Set a gauge, or have it read when reported if value is callable.
+
+        """
+        self.lock.acquire()
+        try:
+            self.gauges[name] = value
+        finally:
+            self.lock.release()
+
+    def remove_gauge(self, name):
+        self.lock.acquire()
+        try:
+            self.gauges.pop(name, None)
+        finally:
+            self.lock.release()
+
+    def observe(self, name, seconds):
+        self.lock.acquire()
+        try:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        """Return all metrics as a JSON serializable dictionary.
+
+        """
+        self.lock.acquire()
+        try:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = dict([(name, histogram.summary()) for name, histogram
+                               in self.histograms.items()])
+        finally:
+            self.lock.release()
+        for name, value in gauges.items():
+            if callable(value):
+                try:
+                    gauges[name] = value()
+                except Exception:
+                    log.exception("Unable to read gauge '%s'" % name)
+                    del gauges[name]
+        return {
+            'time' : time.time(),
+            'uptime' : time.time() - self.started,
+            'counters' : counters,
+            'gauges' : gauges,
+            'histograms' : histograms
+        }
+
+
+registry = Registry()
+
+
+def incr(name, n=1):
+    """Add n to a counter.
+
+    """
+    registry.incr(name, n)
+
+
+def gauge(name, value):
+    """Set a gauge to a value, or to a callable returning it.
+
+    """
+    registry.gauge(name, value)
+
+
+def remove_gauge(name):
+    """Stop reporting a gauge.
+
+    """
+    registry.remove_gauge(name)
+
+
+def observe(name, seconds):
+    """Record a duration in a histogram.
+
+    """
+    registry.observe(name, seconds)
+
+
+class StatsReporter(object):
+    """Write metrics to a stats file and log a summary periodically.
+
+    """
+
+    def __init__(self, registry, path=None, interval=60):
+        """Constructor.
+
+        :param registry: Registry to report
+        :param path: Stats file, rewritten atomically on every report, or
+                     None to only log
+        :param interval: Seconds between reports
+        """
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.thread = None
+
+    def _write(self, snapshot):
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        fp = file(tmp, 'w')
+        try:
+            json.dump(snapshot, fp, sort_keys=True, indent=1)
+        finally:
+            fp.close()
+        os.rename(tmp, self.path)
+
+    def _log(self, snapshot):
+        parts = ['%s=%s' % item for item in sorted(snapshot['counters'].items())]
+        parts.extend(['%s=%s' % item
+                      for item in sorted(snapshot['gauges'].items())])
+        for name, summary in sorted(snapshot['histograms'].items()):
+            if summary['count']:
+                parts.append('%s=%d/%.1f/%.1fms' % (name, summary['count'],
+                                                    summary['p50_ms'],
+                                                    summary['p99_ms']))
+        log.info("Stats: " + ' '.join(parts))
+
+    def report(self):
+        snapshot = self.registry.snapshot()
+        if self.path:
+            try:
+                self._write(snapshot)
+            except EnvironmentError:
+                log.exception("Unable to write stats file '%s'" % self.path)
+        self._log(snapshot)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.report()
+            except Exception:
+                log.exception("Unexpected exception")
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+
+def start_reporting(path=None, interval=60):
+    """Report the metrics of this process every interval seconds.
+
+    Histograms are logged as name=count/p50/p99.
+
+    :return: The StatsReporter, or None if interval is not positive
+    """
+    if interval <= 0:
+        return None
+    reporter = StatsReporter(registry, path, interval)
+    reporter.start()
+    return reporter
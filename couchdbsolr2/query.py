@@ -7,10 +7,12 @@
 # http://www.opensource.org/licenses/mit-license.php
 # for details.
 
-import logging, sys
+import logging, metrics, re, sys, threading, time, Queue
+from cache import CommitStamps, QueryCache
 from optparse import OptionParser
-from solr import SolrConnection
+from solr import ConnectionPool, SolrConnection
 from lineprotocol import LineProtocol
+from util import string2log_level
 
 try:
     import simplejson as json
@@ -19,6 +21,13 @@ except ImportError:
 
 log = logging.getLogger(__name__)
 
+# Parts of a Solr response returned along with the documents, when the
+# query asked for them
+EXTRA_MEMBERS = ('facet_counts', 'highlighting')
+
+_top_level = re.compile(r'""|[{}\[\],:]')
+_nested = re.compile(r'[^{}\[\]]*([{}\[\]])')
+
 
 def query_failed():
     ret = {
@@ -28,19 +37,40 @@ def query_failed():
     return ret
 
 
+def field_list(value):
+    """Split a comma-separated list of field names.
+
+    """
+    return [field.strip() for field in value.split(',') if field.strip()]
+
+
 def build_query(request):
+    """Translate a search request into Solr query parameters.
+
+    Besides q, the request may hold:
+
+    * type, count and offset: document type, rows and start
+    * fields: comma-separated fields to return (fl); _id is always
+      returned. By default Solr returns every stored field.
+    * facets: comma-separated fields to count values of (facet.field),
+      with facet_limit and facet_mincount
+    * highlight: comma-separated fields to highlight matches in (hl.fl),
+      with highlight_snippets and highlight_size (hl.snippets and
+      hl.fragsize)
+
+    Any other parameter is passed on to Solr as is.
+    """
     try:
         db_name = request['db']
         search = request['query']
         query = search['q']
 
-        doctype = search.get('type')
-        count = search.get('count', 25)
-        offset = search.get('offset', 0)
-
-        if 'type' in search: del search['type']
-        if 'count' in search: del search['count']
-        if 'offset' in search: del search['offset']
+        doctype = search.pop('type', None)
+        count = search.pop('count', 25)
+        offset = search.pop('offset', 0)
+        fields = field_list(search.pop('fields', ''))
+        facets = field_list(search.pop('facets', ''))
+        highlight = field_list(search.pop('highlight', ''))
 
         queries = ['_db:%s' % db_name]
         if doctype is not None:
@@ -52,7 +82,26 @@ def build_query(request):
             'rows' : count,
             'start' : offset,
             'wt' : 'json',
+            'omitHeader' : 'true'
         }
+        if fields:
+            if '_id' not in fields:
+                fields.insert(0, '_id')
+            params['fl'] = ','.join(fields)
+        if facets:
+            params['facet'] = 'true'
+            params['facet.field'] = facets
+            for name, param in (('facet_limit', 'facet.limit'),
+                                ('facet_mincount', 'facet.mincount')):
+                if search.has_key(name):
+                    params[param] = search.pop(name)
+        if highlight:
+            params['hl'] = 'true'
+            params['hl.fl'] = ','.join(highlight)
+            for name, param in (('highlight_snippets', 'hl.snippets'),
+                                ('highlight_size', 'hl.fragsize')):
+                if search.has_key(name):
+                    params[param] = search.pop(name)
         for key in [key for key in search.keys() if key not in params]:
             params[key] = search[key]
         return params
@@ -66,38 +115,272 @@ def parse_opts():
     parser.add_option('-l', '--log', dest='log_file',
                       metavar='FILE', default='couchdb-solr2-query.log',
                       help='Write log to FILE (default: %default)')
+    parser.add_option('-L', '--log-level', dest='log_level',
+                      metavar='LEVEL', default='info',
+                      help='Log at LEVEL: debug, info, warning, error or '
+                           'critical (default: %default)')
+    parser.add_option('--stats', dest='stats_file', metavar='FILE',
+                      help='Write metrics to FILE every stats interval')
+    parser.add_option('--stats-interval', dest='stats_interval',
+                      type='float', metavar='SECONDS', default=60,
+                      help='Log a summary of metrics every SECONDS, 0 to '
+                           'disable (default: %default)')
     parser.add_option('-s', '--solr', dest='solr_uri',
                       metavar='URI', default='http://127.0.0.1:8080/solr',
                       help='Solr URI (default: %default)')
+    parser.add_option('--cache-size', dest='cache_size', type='int',
+                      metavar='BYTES', default=0,
+                      help='Cache up to BYTES of search results '
+                           '(default: %default, no caching)')
+    parser.add_option('--cache-ttl', dest='cache_ttl', type='float',
+                      metavar='SECONDS', default=60,
+                      help='Serve cached results for at most SECONDS '
+                           '(default: %default)')
+    parser.add_option('--stamps', dest='stamp_dir', metavar='DIR',
+                      help="Drop cached results of a database once "
+                           "couchdb-solr2-update committed to it, as "
+                           "recorded in DIR (its stamp_dir)")
+    parser.add_option('-j', '--concurrency', dest='concurrency', type='int',
+                      metavar='N', default=1,
+                      help='Run up to N queries at once, answering them in '
+                           'the order they were received (default: %default)')
     return parser.parse_args()
 
 
+def raw_members(text):
+    """Cut the members of a JSON object out of its text, without parsing.
+
+    String contents are blanked out first (escaped quotes and backslashes
+    masked, then the text split on quotes, which happens at C speed), so
+    only the remaining skeleton of brackets and separators is scanned to
+    find where each top-level member starts and ends. Offsets in the
+    skeleton map back to the text by adding the lengths of the strings
+    before them.
+
+    :param text: JSON text of an object, e.g. a Solr response
+    :return: Dictionary of member names to the JSON text of their value,
+             or None if text does not look like a JSON object
+    """
+    masked = text
+    if '\\"' in text:
+        # Same length, so offsets into masked are offsets into text
+        masked = text.replace('\\\\', '__').replace('\\"', '__')
+    parts = masked.split('"')
+    if len(parts) % 2 == 0:
+        return None
+    skeleton = '""'.join(parts[0::2])
+
+    def offset(pos):
+        strings = skeleton.count('"', 0, pos) // 2
+        return pos + sum(map(len, parts[1:2 * strings:2]))
+
+    pos = skeleton.find('{')
+    if pos < 0 or skeleton[:pos].strip():
+        return None
+    members = {}
+    name = value_start = None
+    pos += 1
+    while True:
+        token = _top_level.search(skeleton, pos)
+        if token is None:
+            return None
+        pos = token.end()
+        c = token.group()
+        if c == '""':
+            if value_start is None:
+                start = offset(token.start())
+                name = text[start:offset(pos)]
+        elif c == ':':
+            value_start = pos
+        elif c == '{' or c == '[':
+            depth = 1
+            while depth:
+                bracket = _nested.match(skeleton, pos)
+                if bracket is None:
+                    return None
+                pos = bracket.end()
+                if bracket.group(1) in '{[':
+                    depth += 1
+                else:
+                    depth -= 1
+        elif c == ',' or c == '}':
+            if name is not None and value_start is not None:
+                try:
+                    name = json.loads(name)
+                except ValueError:
+                    return None
+                value = text[offset(value_start):offset(token.start())]
+                members[name] = value.strip()
+            elif c == ',' or name is not None:
+                return None
+            name = value_start = None
+            if c == '}':
+                return members
+        else:
+            return None
+
+
+def run_query(solr, query):
+    """Search Solr.
+
+    The documents found are returned in Solr's response object, together
+    with the members of EXTRA_MEMBERS that Solr returned.
+
+    :return: Response to send back to CouchDB, serialized, or None if
+             the search failed
+    """
+    log.debug("Running query: " + str(query))
+    results = solr.search(**query)
+    if results is None:
+        return
+    members = raw_members(results)
+    if members is not None and members.has_key('response'):
+        # Pass Solr's JSON through rather than decoding and encoding it
+        value = members['response']
+        extra = ['"%s": %s' % (name, members[name]) for name in EXTRA_MEMBERS
+                 if members.has_key(name)]
+        if extra and value.endswith('}'):
+            value = '%s, %s}' % (value[:-1], ', '.join(extra))
+        if '\n' in value or '\r' in value:
+            value = value.replace('\r', ' ').replace('\n', ' ')
+        return '{"code": 200, "json": %s}' % value
+    resp = json.loads(results)
+    result = resp['response']
+    for name in EXTRA_MEMBERS:
+        if resp.has_key(name):
+            result[name] = resp[name]
+    ret = {
+        'code' : 200,
+        'json' : result
+    }
+    return json.dumps(ret)
+
+
+def cached_query(cache, solr, db_name, query):
+    """Search Solr unless the result is cached.
+
+    Only successful searches are cached.
+    """
+    key = cache.key(query)
+    out = cache.get(key)
+    if out is not None:
+        log.debug("Cached result for query: " + key)
+        return out
+    started = time.time()
+    out = run_query(solr, query)
+    if out is not None:
+        cache.put(key, db_name, out, started)
+    return out
+
+
+def handle_request(request, solr, cache=None):
+    """Answer a search request.
+
+    :return: Response to send back to CouchDB, serialized, or None if
+             handling the request failed unexpectedly
+    """
+    start = time.time()
+    metrics.incr('query.requests')
+    try:
+        query = build_query(request)
+        if query is None:
+            metrics.incr('query.failed')
+            return json.dumps(query_failed())
+        if cache is not None:
+            out = cached_query(cache, solr, request['db'], query)
+        else:
+            out = run_query(solr, query)
+        if out is None:
+            metrics.incr('query.failed')
+            return json.dumps({'code' : 400})
+        metrics.observe('query.request', time.time() - start)
+        return out
+    except Exception:
+        log.exception("Uncaught exception")
+        metrics.incr('query.failed')
+
+
+def serve_concurrently(requests, handle, protocol, concurrency, read_ahead=8):
+    """Handle requests on a pool of threads, answering them in order.
+
+    Every request gets a slot, a queue holding its response once a worker
+    handled it. Slots are queued in request order for the writer thread,
+    which waits for each in turn, so a slow query holds back the answers
+    to the requests received after it but not their handling. Reading
+    stops while read_ahead * concurrency requests wait behind the oldest
+    unanswered one.
+
+    :param requests: Iterator of requests
+    :param handle: Callable answering a request, see handle_request
+    :param protocol: LineProtocol to write responses to
+    :param concurrency: Number of worker threads
+    :param read_ahead: Requests read ahead per worker thread
+    """
+    jobs = Queue.Queue()
+    slots = Queue.Queue(concurrency * read_ahead)
+    metrics.gauge('query.waiting', slots.qsize)
+
+    def work():
+        job = jobs.get()
+        while job is not None:
+            request, slot = job
+            slot.put(handle(request))
+            job = jobs.get()
+
+    def write():
+        slot = slots.get()
+        while slot is not None:
+            out = slot.get()
+            if out is not None:
+                protocol.output(out)
+            slot = slots.get()
+
+    workers = [threading.Thread(target=work) for i in xrange(concurrency)]
+    writer = threading.Thread(target=write)
+    for thread in workers + [writer]:
+        thread.setDaemon(True)
+        thread.start()
+    try:
+        for request in requests:
+            slot = Queue.Queue(1)
+            slots.put(slot)
+            jobs.put((request, slot))
+    finally:
+        for thread in workers:
+            jobs.put(None)
+        slots.put(None)
+        writer.join()
+
+
 def main():
     opts, args = parse_opts()
-    logging.basicConfig(filename=opts.log_file, level=logging.DEBUG,
+    logging.basicConfig(filename=opts.log_file,
+                        level=string2log_level(opts.log_level),
                         format='[%(asctime)s|%(levelname)s|%(name)s|%(threadName)s|%(message)s]')
+    metrics.start_reporting(opts.stats_file, opts.stats_interval)
+
+    concurrency = max(opts.concurrency, 1)
+    solr = SolrConnection(opts.solr_uri, pool=ConnectionPool(concurrency))
+    cache = None
+    if opts.cache_size > 0:
+        stamps = None
+        if opts.stamp_dir:
+            stamps = CommitStamps(opts.stamp_dir)
+        cache = QueryCache(opts.cache_size, opts.cache_ttl, stamps)
+        for name in ('hits', 'misses', 'entries', 'bytes', 'evictions',
+                     'invalidations'):
+            metrics.gauge('query.cache_' + name,
+                          lambda name=name: cache.stats()[name])
 
-    solr = SolrConnection(opts.solr_uri)
     protocol = LineProtocol()
-    for request in protocol.input():
-        try:
-            query = build_query(request)
-            if query is None:
-                protocol.output(query_failed(), True)
-                continue
-            log.debug("Running query: " + str(query))
-            results = solr.search(**query)
-            if results is None:
-                protocol.output({'code' : 400})
-                continue
-            resp = json.loads(results)
-            ret = {
-                'code' : 200,
-                'json' : resp['response']
-            }
-            protocol.output(ret, True)
-        except Exception:
-            log.exception("Uncaught exception")
+    handle = lambda request: handle_request(request, solr, cache)
+    if concurrency > 1:
+        serve_concurrently(protocol.input(), handle, protocol, concurrency)
+    else:
+        for request in protocol.input():
+            out = handle(request)
+            if out is not None:
+                protocol.output(out)
     return 0
 
 
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+import logging, random, threading, time
+
+log = logging.getLogger(__name__)
+
+__all__ = ['Backoff', 'CircuitBreaker']
+
+
+class Backoff(object):
+    """Delays between attempts, growing exponentially, with full jitter.
+
+    The delay before retry n (from 0) is drawn uniformly between 0 and
+    min(max_delay, base * 2 ** n), so that clients failing together do
+    not retry together.
+    """
+
+    def __init__(self, retries=5, base=0.5, max_delay=30.0):
+        """Constructor.
+
+        :param retries: Max retries after the first attempt
+        :param base: Upper bound of the first delay, in seconds
+        :param max_delay: Upper bound of any delay, in seconds
+        """
+        self.retries = retries
+        self.base = base
+        self.max_delay = max_delay
+
+    def delays(self):
+        """Yield the delay before each retry.
+
+        """
+        for n in xrange(self.retries):
+            yield random.uniform(0, min(self.max_delay, self.base * 2 ** n))
+
+
+class CircuitBreaker(object):
+    """Tell when a service looks down, from its consecutive failures.
+
+    The breaker opens after threshold consecutive failures. While it is
+    open, wait blocks. After reset_timeout seconds it lets work through
+    again to try the service: a success closes the breaker, and a
+    failure opens it for another reset_timeout seconds.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30.0, name='service'):
+        """Constructor.
+
+        :param threshold: Consecutive failures that open the breaker, 0 to
+                          never open it
+        :param reset_timeout: Seconds the breaker stays open
+        :param name: Name of the service, for logging
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.name = name
+        self.cond = threading.Condition()
+        self.failures = 0
+        self.opened = None
+
+    def success(self):
+        self.cond.acquire()
+        try:
+            self.failures = 0
+            if self.opened is not None:
+                log.info("%s is back, resuming" % self.name)
+                self.opened = None
+                self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def failure(self):
+        self.cond.acquire()
+        try:
+            self.failures += 1
+            if self.threshold <= 0 or self.failures < self.threshold:
+                return
+            now = time.time()
+            if self.opened is None:
+                log.warning("%s failed %d times in a row, pausing for %gs"
+                            % (self.name, self.failures, self.reset_timeout))
+                self.opened = now
+            elif now - self.opened >= self.reset_timeout:
+                log.warning("%s still failing, pausing for %gs"
+                            % (self.name, self.reset_timeout))
+                self.opened = now
+        finally:
+            self.cond.release()
+
+    def is_open(self):
+        """Whether work should wait.
+
+        """
+        self.cond.acquire()
+        try:
+            return self.opened is not None and \
+                time.time() - self.opened < self.reset_timeout
+        finally:
+            self.cond.release()
+
+    def wait(self, cancelled=None):
+        """Block while the breaker is open.
+
+        :param cancelled: Callable telling to stop waiting, or None
+        :return: Seconds waited
+        """
+        start = time.time()
+        self.cond.acquire()
+        try:
+            while self.opened is not None:
+                remaining = self.reset_timeout - (time.time() - self.opened)
+                if remaining <= 0 or (cancelled is not None and cancelled()):
+                    break
+                # At most a second at a time, so signal handlers get to run
+                self.cond.wait(min(remaining, 1.0))
+        finally:
+            self.cond.release()
+        return time.time() - start
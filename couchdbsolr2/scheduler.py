@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+import logging, threading
+
+log = logging.getLogger(__name__)
+
+__all__ = ['DatabaseScheduler', 'fold_notification']
+
+
+def fold_notification(pending, taipu):
+    """Fold an update notification into those pending for a database.
+
+    Repeated 'updated' notifications collapse into one, and a 'deleted'
+    notification makes anything pending before it pointless.
+
+    :param pending: List of pending notification types, modified in place
+    :param taipu: Type of the new notification
+    """
+    if taipu == 'deleted':
+        del pending[:]
+        pending.append(taipu)
+    elif not pending or pending[-1] != taipu:
+        pending.append(taipu)
+
+
+class DatabaseScheduler(object):
+    """Run update notifications on a pool of worker threads.
+
+    Different databases are processed in parallel, but there is never
+    more than one job in flight per database. Notifications arriving for
+    a database that is already being processed are folded into a single
+    follow-up job.
+
+    Which waiting database a free worker picks up is decided by policy:
+
+    * 'fifo': databases are served in the order they were notified
+    * 'lru': the database that was served least recently goes first
+    """
+
+    policies = ('fifo', 'lru')
+
+    def __init__(self, handler, workers=4, policy='fifo'):
+        """Constructor.
+
+        :param handler: Callable taking a database name and a notification
+                        type
+        :param workers: Number of worker threads
+        :param policy: Fairness policy, one of DatabaseScheduler.policies
+        """
+        if policy not in self.policies:
+            raise ValueError("Unknown scheduling policy: '%s'" % policy)
+        self.handler = handler
+        self.workers = workers
+        self.policy = policy
+        self.cond = threading.Condition()
+        self.pending = {}
+        self.ready = []
+        self.running = set()
+        self.served = {}
+        self.clock = 0
+        self.stopping = False
+        self.threads = []
+
+    def start(self):
+        for i in xrange(self.workers):
+            thread = threading.Thread(target=self._work,
+                                      name='scheduler-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, db_name, taipu):
+        """Schedule a notification for a database.
+
+        """
+        self.cond.acquire()
+        try:
+            pending = self.pending.setdefault(db_name, [])
+            idle = not pending and db_name not in self.running
+            fold_notification(pending, taipu)
+            if idle:
+                self.ready.append(db_name)
+                self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def shutdown(self):
+        """Wait for scheduled work to finish and stop the workers.
+
+        """
+        self.cond.acquire()
+        try:
+            self.stopping = True
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        for thread in self.threads:
+            thread.join()
+
+    def _next(self):
+        if self.policy == 'lru':
+            served = [(self.served.get(db_name, 0), i)
+                      for i, db_name in enumerate(self.ready)]
+            return self.ready.pop(min(served)[1])
+        return self.ready.pop(0)
+
+    def _take(self):
+        """Wait for a database with pending work and claim it.
+
+        Returns None once shut down and out of work.
+        """
+        self.cond.acquire()
+        try:
+            while not self.ready:
+                if self.stopping and not self.running:
+                    return
+                self.cond.wait()
+            db_name = self._next()
+            taipu = self.pending[db_name].pop(0)
+            self.running.add(db_name)
+            self.clock += 1
+            self.served[db_name] = self.clock
+            return db_name, taipu
+        finally:
+            self.cond.release()
+
+    def _done(self, db_name):
+        self.cond.acquire()
+        try:
+            self.running.discard(db_name)
+            if self.pending[db_name]:
+                self.ready.append(db_name)
+            else:
+                del self.pending[db_name]
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def _work(self):
+        job = self._take()
+        while job is not None:
+            db_name, taipu = job
+            try:
+                self.handler(db_name, taipu)
+            except Exception:
+                log.exception("Uncaught exception")
+            self._done(db_name)
+            job = self._take()
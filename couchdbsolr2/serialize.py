@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+"""Streaming serializers for Solr add requests.
+
+Documents are lists of (name, value) pairs, as decoded by message.decode.
+The body of an add request is produced piece by piece, in UTF-8 encoded
+chunks of roughly chunk_size bytes, so it can be written straight to the
+HTTP connection instead of being built as a tree and then as one string.
+"""
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+__all__ = ['add_chunks', 'formats', 'json_add_chunks', 'xml_add_chunks']
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _escape(value):
+    if not isinstance(value, basestring):
+        value = unicode(value)
+    if '&' in value:
+        value = value.replace('&', '&amp;')
+    if '<' in value:
+        value = value.replace('<', '&lt;')
+    if '>' in value:
+        value = value.replace('>', '&gt;')
+    return value
+
+
+def _escape_attr(value):
+    value = _escape(value)
+    if '"' in value:
+        value = value.replace('"', '&quot;')
+    return value
+
+
+def xml_add_chunks(docs, chunk_size=CHUNK_SIZE):
+    """Yield the body of an XML add request for docs.
+
+    """
+    buf = [u'<add>']
+    size = 0
+    for doc in docs:
+        buf.append(u'<doc>')
+        for name, value in doc:
+            field = u'<field name="%s">%s</field>' % (_escape_attr(name),
+                                                      _escape(value))
+            buf.append(field)
+            size += len(field)
+        buf.append(u'</doc>')
+        if size >= chunk_size:
+            yield u''.join(buf).encode('utf-8')
+            buf = []
+            size = 0
+    buf.append(u'</add>')
+    yield u''.join(buf).encode('utf-8')
+
+
+def json_add_chunks(docs, chunk_size=CHUNK_SIZE):
+    """Yield the body of a request to Solr's JSON update handler for docs.
+
+    Fields occurring more than once in a document become arrays.
+    """
+    buf = ['[']
+    size = 0
+    separator = ''
+    for doc in docs:
+        fields = {}
+        for name, value in doc:
+            if not fields.has_key(name):
+                fields[name] = value
+            elif isinstance(fields[name], list):
+                fields[name].append(value)
+            else:
+                fields[name] = [fields[name], value]
+        serialized = json.dumps(fields)
+        buf.append(separator)
+        buf.append(serialized)
+        separator = ','
+        size += len(serialized)
+        if size >= chunk_size:
+            yield ''.join(buf)
+            buf = []
+            size = 0
+    buf.append(']')
+    yield ''.join(buf)
+
+
+formats = {
+    'xml' : xml_add_chunks,
+    'json' : json_add_chunks
+}
+
+
+def add_chunks(docs, format='xml', chunk_size=CHUNK_SIZE):
+    return formats[format](docs, chunk_size)
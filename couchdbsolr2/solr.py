@@ -27,7 +27,7 @@
 # data = c.search(q='id:500', wt='python')
 # print 'first match=', eval(data)['response']['docs'][0]
 
-import httplib2, logging, socket, urllib
+import httplib, logging, metrics, socket, threading, time, urllib, urlparse
 from xml.sax.saxutils import escape
 
 try:
@@ -37,34 +37,226 @@ except ImportError:
 
 log = logging.getLogger(__name__)
 
-__all__ = ['SolrConnection']
+__all__ = ['ConnectionPool', 'SolrConnection', 'SolrException']
+
+
+class SolrException(Exception):
+  """ An exception thrown when Solr answers with an error """
+  def __init__(self, httpcode, reason=None, body=None):
+    Exception.__init__(self, httpcode, reason)
+    self.httpcode = httpcode
+    self.reason = reason
+    self.body = body
+
+  def __repr__(self):
+    return 'HTTP code=%s, Reason=%s, body=%s' % (
+      self.httpcode, self.reason, self.body)
+
+  def __str__(self):
+    return 'HTTP code=%s, reason=%s' % (self.httpcode, self.reason)
+
+
+class ConnectionPool(object):
+  """Thread-safe pool of keep-alive HTTP connections.
+
+  At most maxsize connections are open per host; callers wait for one to
+  be released beyond that. Connections idle for more than idle_timeout
+  seconds are closed instead of reused, and a request failing on a
+  connection is retried once on a fresh one, after closing the idle
+  connections to the host, as they are likely stale too (e.g. after a
+  server restart).
+  """
+
+  def __init__(self, maxsize=10, idle_timeout=15):
+    self.maxsize = maxsize
+    self.idle_timeout = idle_timeout
+    self.cond = threading.Condition()
+    self.idle = {}
+    self.size = {}
+    self.opened = 0
+
+  def _acquire(self, key):
+    self.cond.acquire()
+    try:
+      while True:
+        idle = self.idle.get(key)
+        now = time.time()
+        while idle:
+          conn, used = idle.pop()
+          if now - used < self.idle_timeout:
+            return conn
+          conn.close()
+          self.size[key] -= 1
+        if self.size.get(key, 0) < self.maxsize:
+          self.size[key] = self.size.get(key, 0) + 1
+          self.opened += 1
+          if key[0] == 'https':
+            return httplib.HTTPSConnection(key[1])
+          return httplib.HTTPConnection(key[1])
+        self.cond.wait()
+    finally:
+      self.cond.release()
+
+  def _release(self, key, conn, reuse=True):
+    self.cond.acquire()
+    try:
+      if reuse:
+        self.idle.setdefault(key, []).append((conn, time.time()))
+      else:
+        conn.close()
+        self.size[key] -= 1
+      self.cond.notify()
+    finally:
+      self.cond.release()
+
+  def _discard(self, key):
+    """Close the idle connections to a host.
+
+    """
+    self.cond.acquire()
+    try:
+      for conn, used in self.idle.pop(key, []):
+        conn.close()
+        self.size[key] -= 1
+      self.cond.notifyAll()
+    finally:
+      self.cond.release()
+
+  def _send_chunked(self, conn, method, path, chunks, headers):
+    if conn.sock is None:
+      conn.connect()
+      # Chunks are written one by one; don't let Nagle's algorithm hold
+      # them back waiting for delayed ACKs
+      conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    conn.putrequest(method, path)
+    for header, value in headers.items():
+      conn.putheader(header, value)
+    conn.putheader('Transfer-Encoding', 'chunked')
+    conn.endheaders()
+    for chunk in chunks:
+      if isinstance(chunk, unicode):
+        chunk = chunk.encode('utf-8')
+      if chunk:
+        conn.send('%x\r\n%s\r\n' % (len(chunk), chunk))
+    conn.send('0\r\n\r\n')
+
+  def request(self, url, method='GET', body=None, headers={}):
+    """Make an HTTP request on a pooled connection.
+
+    body may also be a callable returning an iterator of strings, which
+    are streamed with chunked transfer encoding. It is called again if
+    the request needs to be retried.
+
+    :return: Tuple of response status and content
+    """
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    key = (scheme, netloc)
+    if query:
+      path += '?' + query
+    if isinstance(body, unicode):
+      body = body.encode('utf-8')
+    attempts = 2
+    while True:
+      attempts -= 1
+      conn = self._acquire(key)
+      reuse = False
+      try:
+        try:
+          if callable(body):
+            self._send_chunked(conn, method, path, body(), headers)
+          else:
+            conn.request(method, path, body, headers)
+          response = conn.getresponse()
+          content = response.read()
+          reuse = not response.will_close
+        except (httplib.HTTPException, socket.error):
+          if attempts == 0:
+            raise
+          log.debug("Reconnecting to %s" % netloc)
+          self._discard(key)
+          continue
+      finally:
+        # Whatever went wrong, the connection is given back
+        self._release(key, conn, reuse)
+      return response.status, content
+
+  def close(self):
+    """Close all idle connections.
+
+    """
+    self.cond.acquire()
+    try:
+      for key, idle in self.idle.items():
+        for conn, used in idle:
+          conn.close()
+          self.size[key] -= 1
+      self.idle = {}
+    finally:
+      self.cond.release()
 
 
 class SolrConnection(object):
 
-  def __init__(self, uri='http://localhost:8983/solr', postHeaders={}):
+  def __init__(self, uri='http://localhost:8983/solr', postHeaders={},
+               pool=None):
     self.uri = uri
-    self.conn = httplib2.Http()
+    if pool is None:
+      pool = ConnectionPool(1)
+    self.pool = pool
     self.xmlheaders = {'Content-Type': 'application/xml; charset=utf-8'}
     self.xmlheaders.update(postHeaders)
+    self.jsonheaders = {'Content-Type': 'application/json; charset=utf-8'}
+    self.jsonheaders.update(postHeaders)
     self.formheaders = {'Content-Type': 'application/x-www-form-urlencoded; charset=utf-8'}
+    # HTTP status of the last request, None if it got no answer
+    self.lastStatus = None
 
   def __str__(self):
     return 'SolrConnection{uri=%s, postHeaders=%s}' % (self.uri, self.xmlheaders)
 
+  def _metric(self, url, body):
+    if url.endswith('/select'):
+      return 'solr.search'
+    if isinstance(body, basestring) and \
+        (body.startswith('<commit') or body.startswith('<optimize')):
+      return 'solr.commit'
+    return 'solr.update'
+
   def doPost(self,url,body,headers):
+    metric = self._metric(url, body)
+    start = time.time()
+    self.lastStatus = None
     try:
-      response, content = self.conn.request(url, 'POST', body, headers)
-      if response.status != 200:
-        log.error("HTTP request returned code %d" % response.status)
+      status, content = self.pool.request(url, 'POST', body, headers)
+      self.lastStatus = status
+      if status != 200:
+        log.error("HTTP request returned code %d" % status)
+        metrics.incr(metric + '_errors')
         return None
-    except httplib2.HttpLib2Error:
+    except (httplib.HTTPException, socket.error):
       log.exception("HTTP error")
+      metrics.incr(metric + '_errors')
       return None
+    metrics.observe(metric, time.time() - start)
     return content
 
   def doUpdateXML(self, request):
     data = self.doPost(self.uri + '/update', request, self.xmlheaders)
+    return self.checkUpdate(data)
+
+  def doUpdateStream(self, chunks, format='xml'):
+    """Send an update request body without building it in memory.
+
+    :param chunks: Callable returning an iterator of body chunks
+    :param format: 'xml' or 'json' (Solr's JSON update handler)
+    """
+    if format == 'json':
+      url, headers = self.uri + '/update/json', self.jsonheaders
+    else:
+      url, headers = self.uri + '/update', self.xmlheaders
+    return self.checkUpdate(self.doPost(url, chunks, headers))
+
+  def checkUpdate(self, data):
     if data is None:
       return None
     response = ET.fromstring(data)
@@ -74,7 +266,7 @@ class SolrConnection(object):
           if lst_int.get('name') == 'status':
             solr_status = int(lst_int.text)
             if solr_status != 0:
-              raise SolrException(rsp.status, solr_status)
+              raise SolrException(200, 'status %d' % solr_status, data)
             break
         break
     return data
@@ -89,6 +281,24 @@ class SolrConnection(object):
     xstr = '<delete><id>' + self.escapeVal(id) + '</id></delete>'
     return self.doUpdateXML(xstr)
 
+  def deleteMany(self, ids, chunk=1000):
+    """Delete documents by id, chunk ids per request.
+
+    Returns the last response, or None as soon as a request fails.
+    """
+    data = ''
+    for i in xrange(0, len(ids), chunk):
+      lst = ['<delete>']
+      for id in ids[i:i + chunk]:
+        lst.append('<id>')
+        lst.append(self.escapeVal(id))
+        lst.append('</id>')
+      lst.append('</delete>')
+      data = self.doUpdateXML(''.join(lst))
+      if data is None:
+        return None
+    return data
+
   def deleteByQuery(self, query):
     xstr = '<delete><query>'+self.escapeVal(query)+'</query></delete>'
     return self.doUpdateXML(xstr)
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+"""Durable first-in first-out queue of messages in segment files.
+
+Messages are appended to the newest segment of a directory, each as a
+record of a header (CRC32 of the rest, lengths of the properties and of
+the body), the AMQP message properties as JSON, and the body. A segment
+that reaches segment_bytes is closed and a new one started. Messages are
+read back in order from a cursor file recording the segment and offset of
+the first one not yet consumed. Segments are removed once fully consumed.
+
+Appends are synced to disk before they return. An append that fails
+(e.g. on a full disk) is cut off its segment, or the segment is closed if
+that fails too. A record torn by a crash fails its CRC and is skipped over
+to the next valid one. The cursor is replaced atomically but not synced,
+so a crash may have messages read again, never lost.
+"""
+
+import errno, fcntl, logging, os, struct, zlib
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+log = logging.getLogger(__name__)
+
+__all__ = ['SegmentSpool', 'SpoolLocked']
+
+_HEADER = struct.Struct('>III')
+_SUFFIX = '.seg'
+
+
+class SpoolLocked(Exception):
+    """Another process uses the spool directory."""
+
+
+class SegmentSpool(object):
+    """Not thread safe: callers serialize access.
+
+    """
+
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024):
+        """Constructor.
+
+        :param directory: Directory of the spool, created if missing
+        :param segment_bytes: Size after which a new segment is started
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock_fd = os.open(os.path.join(directory, 'lock'),
+                               os.O_WRONLY | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            os.close(self.lock_fd)
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                raise SpoolLocked, "Spool '%s' is in use" % directory
+            raise
+        self.segments = self._segments()
+        self.cursor = self._read_cursor()
+        self.writer = None
+        self.reader = None
+        self.reader_segment = None
+        self.count = self._count()
+
+    def _path(self, segment):
+        return os.path.join(self.directory, '%010d%s' % (segment, _SUFFIX))
+
+    def _segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.endswith(_SUFFIX):
+                try:
+                    segments.append(int(name[:-len(_SUFFIX)]))
+                except ValueError:
+                    pass
+        segments.sort()
+        return segments
+
+    def _read_cursor(self):
+        """Segment and offset of the first message not consumed.
+
+        """
+        path = os.path.join(self.directory, 'cursor')
+        try:
+            segment, offset = json.load(file(path))
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            segment, offset = None, 0
+        except ValueError:
+            log.exception("Error reading spool cursor '%s'" % path)
+            segment, offset = None, 0
+        if not self.segments:
+            return None, 0
+        if segment not in self.segments:
+            return self.segments[0], 0
+        return segment, offset
+
+    def _write_cursor(self):
+        path = os.path.join(self.directory, 'cursor')
+        tmp = path + '.tmp'
+        fp = file(tmp, 'w')
+        try:
+            json.dump(list(self.cursor), fp)
+        finally:
+            fp.close()
+        os.rename(tmp, path)
+
+    def _records(self, fp):
+        """Yield (properties, body, end offset) from the position of fp.
+
+        Stops at the end of the file, or at a torn record that no valid
+        one follows.
+        """
+        while True:
+            start = fp.tell()
+            header = fp.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            crc, meta_len, body_len = _HEADER.unpack(header)
+            data = fp.read(meta_len + body_len)
+            if len(data) < meta_len + body_len or \
+                    zlib.crc32(data) & 0xffffffff != crc:
+                log.error("Torn record in spool segment '%s' at offset %d"
+                          % (fp.name, start))
+                if not self._resync(fp, start + 1):
+                    return
+                continue
+            properties = dict((str(k), v) for k, v in
+                              json.loads(data[:meta_len]).items())
+            yield properties, data[meta_len:], fp.tell()
+
+    def _resync(self, fp, offset):
+        """Move fp to the first valid record from offset on.
+
+        Properties are a JSON object, so a record starts _HEADER.size bytes
+        before a '{'.
+
+        :return: False if there is none
+        """
+        fp.seek(offset)
+        rest = fp.read()
+        i = rest.find('{', _HEADER.size)
+        while i >= 0:
+            crc, meta_len, body_len = _HEADER.unpack(rest[i - _HEADER.size:i])
+            data = rest[i:i + meta_len + body_len]
+            if len(data) == meta_len + body_len and \
+                    zlib.crc32(data) & 0xffffffff == crc:
+                log.warning("Skipped %d byte(s) of spool segment '%s'"
+                            % (i - _HEADER.size + 1, fp.name))
+                fp.seek(offset + i - _HEADER.size)
+                return True
+            i = rest.find('{', i + 1)
+        return False
+
+    def _count(self):
+        count = 0
+        segment, offset = self.cursor
+        for s in self.segments:
+            if segment is not None and s < segment:
+                continue
+            fp = file(self._path(s), 'rb')
+            try:
+                if s == segment:
+                    fp.seek(offset)
+                for record in self._records(fp):
+                    count += 1
+            finally:
+                fp.close()
+        return count
+
+    def __len__(self):
+        return self.count
+
+    def append(self, body, properties):
+        """Add a message at the end of the spool, durably.
+
+        :param body: Message body, a string
+        :param properties: AMQP message properties
+        """
+        if self.writer is None or \
+                os.fstat(self.writer).st_size >= self.segment_bytes:
+            self._next_segment()
+        meta = json.dumps(properties)
+        data = meta + body
+        record = _HEADER.pack(zlib.crc32(data) & 0xffffffff,
+                              len(meta), len(body)) + data
+        offset = os.fstat(self.writer).st_size
+        try:
+            while record:
+                record = record[os.write(self.writer, record):]
+            os.fsync(self.writer)
+        except OSError:
+            self._cut(offset)
+            raise
+        self.count += 1
+
+    def _cut(self, offset):
+        """Remove what a failed append wrote past offset.
+
+        If that fails too, the segment is closed, so that later appends go
+        to a new one and readers skip the torn record (see _records).
+        """
+        try:
+            os.ftruncate(self.writer, offset)
+            return
+        except OSError:
+            log.exception("Unable to truncate spool segment '%s'"
+                          % self._path(self.segments[-1]))
+        os.close(self.writer)
+        self.writer = None
+
+    def _next_segment(self):
+        if self.writer is not None:
+            os.close(self.writer)
+        segment = self.segments and self.segments[-1] + 1 or 1
+        self.segments.append(segment)
+        self.writer = os.open(self._path(segment),
+                              os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        if self.cursor[0] is None:
+            self.cursor = (segment, 0)
+        log.info("Started spool segment '%s'" % self._path(segment))
+
+    def peek(self):
+        """First message not consumed, as (body, properties), or None.
+
+        """
+        while self.count > 0:
+            segment, offset = self.cursor
+            if self.reader_segment != segment:
+                if self.reader is not None:
+                    self.reader.close()
+                self.reader = file(self._path(segment), 'rb')
+                self.reader_segment = segment
+            self.reader.seek(offset)
+            for properties, body, end in self._records(self.reader):
+                self.next_offset = end
+                return body, properties
+            if segment == self.segments[-1]:
+                # Torn tail of the segment being written: nothing to read
+                return None
+            self._drop_segment()
+        return None
+
+    def consume(self):
+        """Mark the message returned by peek as consumed.
+
+        """
+        self.cursor = (self.cursor[0], self.next_offset)
+        self.count -= 1
+        if self.count == 0 or (self.cursor[0] != self.segments[-1] and
+                               self.cursor[1] >= os.path.getsize(
+                                   self._path(self.cursor[0]))):
+            self._drop_segment()
+        self._write_cursor()
+
+    def _drop_segment(self):
+        """Remove the segment at the cursor and move to the next one.
+
+        """
+        segment = self.cursor[0]
+        if self.reader_segment == segment:
+            self.reader.close()
+            self.reader, self.reader_segment = None, None
+        if segment == self.segments[-1]:
+            if self.writer is not None:
+                os.close(self.writer)
+                self.writer = None
+        os.unlink(self._path(segment))
+        self.segments.remove(segment)
+        if self.segments:
+            self.cursor = (self.segments[0], 0)
+        else:
+            self.cursor = (None, 0)
+            self.count = 0
+        self._write_cursor()
+
+    def close(self):
+        if self.writer is not None:
+            os.close(self.writer)
+        if self.reader is not None:
+            self.reader.close()
+        self.writer = self.reader = None
+        os.close(self.lock_fd)
@@ -0,0 +1,159 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+"""Report how far Solr lags behind CouchDB, per database.
+
+Compares three positions in the changes of every database: the last
+update_seq of CouchDB, the last sequence id couchdb-solr2-index announced
+(its seqid file) and the last one Solr accepted (the status_file of
+couchdb-solr2-update).
+"""
+
+import couchdb, logging, os, sys, time
+from checkpoint import CheckpointStore
+from optparse import OptionParser
+from util import read_config
+from version import version
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+log = logging.getLogger(__name__)
+
+
+def _update_seq(server, db_name):
+    try:
+        return server[db_name].info()['update_seq']
+    except Exception, e:
+        log.warning("Unable to read update_seq of '%s': %s" % (db_name, e))
+
+
+def lag(db_name, update_seq, announced, confirmed, now):
+    """Status of a database.
+
+    :param update_seq: Last sequence id of the database, or None
+    :param announced: Last sequence id announced, or None
+    :param confirmed: Last status_file entry of the database, or None
+    :param now: Current time
+    :return: Dictionary of positions, lag_docs (changes not yet accepted
+             by Solr), lag_seconds (how old the view of the database in
+             Solr is, 0 when it is up to date) and latency (seconds from
+             announcing the last accepted change to Solr accepting it)
+    """
+    status = {
+        'db' : db_name,
+        'update_seq' : update_seq,
+        'announced' : announced,
+        'confirmed' : None,
+        'lag_docs' : None,
+        'lag_seconds' : None,
+        'latency' : None
+    }
+    if confirmed is not None:
+        status['confirmed'] = confirmed['seq']
+        if confirmed.get('ts') is not None:
+            status['latency'] = round(confirmed['confirmed'] - confirmed['ts'], 3)
+            if update_seq is not None and confirmed['seq'] >= update_seq:
+                status['lag_seconds'] = 0
+            else:
+                status['lag_seconds'] = round(now - confirmed['ts'], 3)
+    if isinstance(update_seq, (int, long)):
+        seq = confirmed and confirmed['seq'] or 0
+        if isinstance(seq, (int, long)):
+            status['lag_docs'] = max(update_seq - seq, 0)
+    return status
+
+
+def collect(couchdb_uri, seqid_file, status_file):
+    """Status of every database known to the indexer or the updater.
+
+    :return: List of results of lag, ordered by database name
+    """
+    announced = {}
+    if seqid_file and os.path.isfile(seqid_file):
+        announced = CheckpointStore(seqid_file).snapshot()
+    confirmed = {}
+    if status_file and os.path.isfile(status_file):
+        confirmed = CheckpointStore(status_file).snapshot()
+
+    server = couchdb.Server(couchdb_uri)
+    now = time.time()
+    statuses = []
+    for db_name in sorted(set(announced.keys()) | set(confirmed.keys())):
+        statuses.append(lag(db_name, _update_seq(server, db_name),
+                            announced.get(db_name), confirmed.get(db_name),
+                            now))
+    return statuses
+
+
+def format_table(statuses):
+    rows = [('database', 'update_seq', 'announced', 'confirmed', 'lag_docs',
+             'lag_s', 'latency_s')]
+    for status in statuses:
+        rows.append(tuple([status['db']] + [
+            status[key] is None and '?' or str(status[key])
+            for key in ('update_seq', 'announced', 'confirmed', 'lag_docs',
+                        'lag_seconds', 'latency')]))
+    widths = [max([len(row[i]) for row in rows]) for i in range(len(rows[0]))]
+    lines = []
+    for row in rows:
+        lines.append('  '.join([row[0].ljust(widths[0])] +
+                               [cell.rjust(width) for cell, width
+                                in zip(row[1:], widths[1:])]))
+    return '\n'.join(lines)
+
+
+def parse_opts():
+    parser = OptionParser(usage="%prog [-i FILE] [-u FILE] [--json]",
+                          version="CouchDB-Solr2 %s" % version)
+    parser.add_option('-i', '--index-config', dest='index_config',
+                      metavar='FILE', default='couchdb-solr2-index.ini',
+                      help='Configuration of couchdb-solr2-index '
+                           '(default: %default)')
+    parser.add_option('-u', '--update-config', dest='update_config',
+                      metavar='FILE', default='couchdb-solr2-update.ini',
+                      help='Configuration of couchdb-solr2-update '
+                           '(default: %default)')
+    parser.add_option('--json', dest='json', action='store_true',
+                      default=False, help='Print JSON instead of a table')
+    return parser.parse_args()
+
+
+def main():
+    opts, args = parse_opts()
+    logging.basicConfig(level=logging.WARNING,
+                        format='%(levelname)s: %(message)s')
+    index_config = read_config(opts.index_config, {
+        'index' : {'seqid' : '.couchdb_seq_id'},
+        'couchdb' : {'uri' : 'http://127.0.0.1:5984/'}
+    })
+    if index_config is None:
+        print >> sys.stderr, "Configuration file '%s' not found" \
+            % opts.index_config
+        return 1
+    update_config = read_config(opts.update_config,
+                                {'update' : {'status_file' : ''}})
+    status_file = update_config and update_config['update']['status_file']
+    if not status_file:
+        print >> sys.stderr, 'No status_file set for couchdb-solr2-update, ' \
+            'only announced changes are reported'
+
+    statuses = collect(index_config['couchdb']['uri'],
+                       index_config['index']['seqid'], status_file)
+    if opts.json:
+        print json.dumps(statuses, sort_keys=True, indent=1)
+    else:
+        print format_table(statuses)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
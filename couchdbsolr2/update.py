@@ -7,14 +7,24 @@
 # http://www.opensource.org/licenses/mit-license.php
 # for details.
 
-import logging, signal, sys
+import logging, metrics, os, signal, sys
+from asyncupdater import AsyncSolrUpdater
+from commit import parse_window
 from daemon import daemonize
+from deadletter import DeadLetterSpool
 from optparse import OptionParser
+from serialize import formats
 from updater import SolrUpdater
 from util import *
 from version import version
 
 
+engines = {
+    'threaded' : SolrUpdater,
+    'async' : AsyncSolrUpdater
+}
+
+
 def validate_amqp(amqp):
     return amqp and amqp.has_key('host') and amqp.has_key('user') \
         and amqp.has_key('password') and amqp.has_key('routing_key') \
@@ -25,10 +35,35 @@ def configure(config_file):
     defaults = {
         'log' : {
             'file' : 'couchdb-solr2-update.log',
-            'level' : 'info'
+            'level' : 'info',
+            'stats_file' : '',
+            'stats_interval' : '60'
         },
         'solr' : {
-            'uri' : 'http://127.0.0.1:8080/solr'
+            'uri' : 'http://127.0.0.1:8080/solr',
+            'connections' : '10',
+            'commit_interval' : '0',
+            'commit_docs' : '10000',
+            'commit_wait' : 'true',
+            'optimize_window' : '',
+            'delete_chunk' : '1000',
+            'update_format' : 'xml',
+            'stamp_dir' : ''
+        },
+        'update' : {
+            'buffer_docs' : '0',
+            'buffer_age' : '1.0',
+            'status_file' : '',
+            'workers' : '10',
+            'queue_size' : '0',
+            'engine' : 'threaded',
+            'max_in_flight' : '200',
+            'retries' : '5',
+            'retry_delay' : '0.5',
+            'retry_max_delay' : '30',
+            'breaker_failures' : '5',
+            'breaker_reset' : '30',
+            'dead_letter' : '/usr/local/couchdb/var/lib/couchdb/couchdb-solr2-update.dead_letter'
         }
     }
     config = read_config(config_file, defaults)
@@ -38,11 +73,19 @@ def configure(config_file):
     if not validate_amqp(config.get('amqp')):
         print >> sys.stderr, 'AMQP configuration is invalid'
         return
+    if config['solr']['update_format'] not in formats:
+        print >> sys.stderr, 'Update format must be one of: %s' \
+            % ', '.join(formats.keys())
+        return
+    if config['update']['engine'] not in engines:
+        print >> sys.stderr, 'Update engine must be one of: %s' \
+            % ', '.join(engines)
+        return
     return config
 
 
 def parse_opts():
-    parser = OptionParser(usage="%prog -c FILE [-n] [-p FILE]",
+    parser = OptionParser(usage="%prog -c FILE [-n] [-p FILE] [--replay]",
                           version="CouchDB-Solr2 %s" % version)
     parser.add_option('-p', '--pid', dest='pid_file',
                       metavar='FILE', default='couchdb-solr2-update.pid',
@@ -53,6 +96,10 @@ def parse_opts():
     parser.add_option('-c', '--config', dest='config_file',
                       metavar='FILE', default='couchdb-solr2-update.ini',
                       help='Configuration (default: %default)')
+    parser.add_option('--replay', dest='replay',
+                      action='store_true', default=False,
+                      help="Apply the messages of the dead letter spool "
+                           "again, then exit")
     return parser.parse_args()
 
 
@@ -62,7 +109,20 @@ def main():
     if config is None:
         return 1
 
-    if opts.no_daemonize is False:
+    if opts.replay and not config['update']['dead_letter']:
+        print >> sys.stderr, 'No dead_letter file configured'
+        return 1
+    if config['update']['dead_letter']:
+        # The daemon runs in /
+        dead_letter = os.path.abspath(config['update']['dead_letter'])
+        config['update']['dead_letter'] = dead_letter
+        try:
+            DeadLetterSpool(dead_letter).check()
+        except EnvironmentError, e:
+            print >> sys.stderr, "Unable to write dead_letter file: %s" % e
+            return 1
+
+    if opts.no_daemonize is False and not opts.replay:
         daemonize(opts.pid_file)
 
     # File handles will be closed during daemonization
@@ -70,13 +130,44 @@ def main():
     logging.basicConfig(filename=config['log']['file'],
                         level=string2log_level(config['log']['level']),
                         format=log_format)
+    metrics.start_reporting(config['log']['stats_file'] or None,
+                            float(config['log']['stats_interval']))
 
-    updater = SolrUpdater(config['amqp'], config['solr']['uri'])
+    engine = engines[config['update']['engine']]
+    kwargs = {}
+    if engine is AsyncSolrUpdater:
+        kwargs['max_in_flight'] = int(config['update']['max_in_flight'])
+    updater = engine(config['amqp'], config['solr']['uri'],
+                     buffer_docs=int(config['update']['buffer_docs']),
+                     buffer_age=float(config['update']['buffer_age']),
+                     prefetch=int(config['amqp'].get('prefetch', 0)),
+                     connections=int(config['solr']['connections']),
+                     commit_interval=float(config['solr']['commit_interval']),
+                     commit_docs=int(config['solr']['commit_docs']),
+                     commit_wait=config['solr']['commit_wait'] == 'true',
+                     optimize_window=parse_window(config['solr']['optimize_window']),
+                     delete_chunk=int(config['solr']['delete_chunk']),
+                     update_format=config['solr']['update_format'],
+                     stamp_dir=config['solr']['stamp_dir'] or None,
+                     status_file=config['update']['status_file'] or None,
+                     retries=int(config['update']['retries']),
+                     retry_delay=float(config['update']['retry_delay']),
+                     retry_max_delay=float(config['update']['retry_max_delay']),
+                     breaker_failures=int(config['update']['breaker_failures']),
+                     breaker_reset=float(config['update']['breaker_reset']),
+                     dead_letter=config['update']['dead_letter'] or None,
+                     **kwargs)
+    if opts.replay:
+        applied, kept = updater.replay()
+        print "Applied %d message(s), %d left in %s" \
+            % (applied, kept, config['update']['dead_letter'])
+        return kept and 3 or 0
     if updater.start_amqp() is False:
         print >> sys.stderr, "Problem connecting to AMQP broker"
         return 2
-    signal.signal(signal.SIGTERM, lambda s, f: updater.shutdown())
-    updater.process_updates()
+    signal.signal(signal.SIGTERM, lambda s, f: updater.stop())
+    updater.process_updates(int(config['update']['workers']),
+                            int(config['update']['queue_size']))
     return 0
 
 
@@ -6,110 +6,785 @@
 # http://www.opensource.org/licenses/mit-license.php
 # for details.
 
-# TODO: Associate SolrConnection with worker threads if possible
-
-import logging, socket, threadpool, time
+import errno, fcntl, logging, metrics, os, select, socket, threading, time
+import Queue
 import amqplib.client_0_8 as amqp
-from solr import SolrConnection
+from cache import ALL_DATABASES, CommitStamps
+from checkpoint import CheckpointStore
+from commit import CommitScheduler
+from deadletter import DeadLetterSpool
+from executor import BoundedExecutor
+from message import decode
+from retry import Backoff, CircuitBreaker
+from serialize import add_chunks
+from solr import ConnectionPool, SolrConnection, SolrException
 
-try:
-    import simplejson as json
-except ImportError:
-    import json
+log = logging.getLogger(__name__)
 
-try:
-    import cElementTree as ET
-except ImportError:
-    import xml.etree.ElementTree as ET
+__all__ = ['SolrUpdater', 'ACCEPTED', 'REJECTED', 'UNAVAILABLE']
 
-log = logging.getLogger(__name__)
+# Outcomes of sending an update to Solr
+ACCEPTED = 'accepted'
+REJECTED = 'rejected'
+UNAVAILABLE = 'unavailable'
 
-__all__ = ['SolrUpdater']
+# Max pages per database tracked for the status file (see _track)
+MAX_PAGES = 10000
 
 
 class SolrUpdater(object):
 
-    def __init__(self, amqp, solr_uri, sleep_time=0.1):
+    def __init__(self, amqp, solr_uri, buffer_docs=0, buffer_age=1.0,
+                 prefetch=0, connections=10, commit_interval=0,
+                 commit_docs=10000, commit_wait=True,
+                 optimize_window=None, delete_chunk=1000, update_format='xml',
+                 stamp_dir=None, status_file=None, retries=5, retry_delay=0.5,
+                 retry_max_delay=30.0, breaker_failures=5, breaker_reset=30.0,
+                 dead_letter=None):
+        """Constructor.
+
+        :param amqp: AMQP configuration
+        :param solr_uri: Solr URI
+        :param buffer_docs: Documents gathered from several messages into a
+                            single Solr add request, 0 to send every message
+                            on its own. Either way, messages are
+                            acknowledged only once Solr accepted them.
+        :param buffer_age: Max seconds a buffered document waits for others
+        :param prefetch: Max unacknowledged messages the broker delivers
+                         (0 for no limit)
+        :param connections: Max keep-alive connections to Solr shared by
+                            the workers
+        :param commit_interval: Max seconds between a change and the commit
+                                that makes it visible. 0 commits right after
+                                every deletion and leaves commits of added
+                                documents to Solr's autoCommit.
+        :param commit_docs: Changed documents that trigger a commit before
+                            commit_interval has passed
+        :param commit_wait: Whether commits wait for flush and a new searcher
+        :param optimize_window: (start, end) minutes of the day within which
+                                to optimize the index, or None to never
+                                optimize. Requires commit_interval.
+        :param delete_chunk: Max ids deleted per Solr request
+        :param update_format: Format of add requests, 'xml' or 'json'
+        :param stamp_dir: Directory of commit stamps telling
+                          couchdb-solr2-query which databases changed
+                          (see cache.CommitStamps), or None
+        :param status_file: File recording, per database, the last update
+                            Solr accepted (read by couchdb-solr2-status),
+                            or None
+        :param retries: Retries of an update Solr failed to apply with
+                        growing delays, after which it is retried every
+                        retry_max_delay until Solr is back
+        :param retry_delay: Upper bound of the delay before the first
+                            retry, doubling for every other one
+        :param retry_max_delay: Upper bound of any delay between retries
+        :param breaker_failures: Consecutive failures after which Solr is
+                                 deemed down and consumption pauses, 0 to
+                                 never pause
+        :param breaker_reset: Seconds consumption pauses before trying
+                              Solr again
+        :param dead_letter: File spooling the messages Solr rejected (see
+                            replay), or None to drop them
+        """
         self.amqp = amqp
         self.solr_uri = solr_uri
-        self.sleep_time = sleep_time
+        self.buffer_docs = buffer_docs
+        self.buffer_age = buffer_age
+        self.prefetch = prefetch
+        self.delete_chunk = delete_chunk
+        self.update_format = update_format
+        self.solr_pool = ConnectionPool(connections)
+        self.stamps = None
+        if stamp_dir:
+            self.stamps = CommitStamps(stamp_dir)
+        self.status = None
+        if status_file:
+            self.status = CheckpointStore(status_file)
+        self.status_lock = threading.Lock()
+        # Per database, pages not all settled yet: indexes of their messages
+        # still to settle, and announce time
+        self.pages = {}
+        self.backoff = Backoff(retries, retry_delay, retry_max_delay)
+        self.breaker = CircuitBreaker(breaker_failures, breaker_reset, 'Solr')
+        self.retry_wakeup = threading.Event()
+        self.dead_letters = None
+        if dead_letter:
+            self.dead_letters = DeadLetterSpool(dead_letter)
         self.pool = None
         self.workers = 0
+        self.stopping = False
+        self.flusher = None
+        self.flusher_wakeup = threading.Event()
+        self.buffer = []
+        self.buffer_msgs = []
+        self.buffer_marks = []
+        self.buffer_started = None
+        self.buffer_lock = threading.Lock()
+        # Flushes taken from the buffer and not done yet
+        self.flushes = 0
+        self.flushes_cond = threading.Condition()
+        # Messages to acknowledge or requeue, from the consuming thread
+        # only: amqplib is not thread safe
+        self.settled = Queue.Queue()
+        self.wake_read, self.wake_write = os.pipe()
+        for fd in (self.wake_read, self.wake_write):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        if commit_interval > 0:
+            on_commit = self.stamps and self.stamps.touch or None
+            self.commits = CommitScheduler(self._solr, commit_interval,
+                                           commit_docs, commit_wait,
+                                           optimize_window, on_commit)
+        else:
+            self.commits = None
+
+    def _solr(self):
+        return SolrConnection(self.solr_uri, pool=self.solr_pool)
+
+    def _doc_dbs(self, docs):
+        """Names of the databases of documents, if commits are stamped.
+
+        """
+        dbs = set()
+        if self.stamps is None:
+            return dbs
+        for doc in docs:
+            # The announcer appends _db last
+            for name, value in reversed(doc):
+                if name == '_db':
+                    dbs.add(value)
+                    break
+        return dbs
+
+    def _add(self, solr, docs):
+        """Add documents to Solr.
+
+        :return: True if Solr accepted them
+        """
+        log.debug("Sending %d document(s) to Solr" % len(docs))
+        chunks = lambda: add_chunks(docs, self.update_format)
+        if solr.doUpdateStream(chunks, self.update_format) is None:
+            return False
+        metrics.incr('update.docs', len(docs))
+        if self.commits is not None:
+            self.commits.mark_dirty(len(docs), self._doc_dbs(docs))
+        return True
+
+    def _commit(self, solr, docs, dbs):
+        """Commit deletions, or leave it to the commit scheduler.
+
+        :param docs: Number of deleted documents
+        :param dbs: Names of the databases of the documents
+        """
+        if self.commits is not None:
+            self.commits.mark_dirty(docs, dbs)
+            return True
+        if solr.commit() is None:
+            return False
+        if self.stamps is not None:
+            self.stamps.touch(dbs)
+        return True
+
+    def _apply(self, solr, updates):
+        """Apply a decoded update message to Solr.
+
+        :return: True if Solr accepted every request that was made
+        """
+        if updates['type'] == 'updated':
+            return self._add(solr, updates['data'])
+        elif updates['type'] == 'deleted':
+            ids = updates['data']
+            log.debug("Deleting %d document(s)" % len(ids))
+            ok = solr.deleteMany(ids, self.delete_chunk) is not None
+            metrics.incr('update.deleted_docs', len(ids))
+            dbs = [updates.get('db', ALL_DATABASES)]
+            return self._commit(solr, len(ids), dbs) and ok
+        elif updates['type'] == 'deleted_db':
+            db_name = updates['data']
+            log.info("Deleting indexes for database '%s'" % db_name)
+            ok = solr.deleteByQuery("_db:%s" % db_name) is not None
+            return self._commit(solr, 1, [db_name]) and ok
+        else:
+            log.warning("Unrecognized update type: '%s'" % updates['type'])
+            return True
+
+    def _retrying(self, apply, bounded=False):
+        """Call apply until Solr accepts the update, backing off in between.
+
+        Delays grow as given by self.backoff, then stay at its max_delay,
+        and retries also wait while the circuit breaker is open: an update
+        is held until Solr is back rather than handed back to the broker
+        to be delivered again right away. Retries stop when Solr rejects
+        the update itself (a 4xx status or an error status in its
+        response), as they cannot help, and when shutting down.
+
+        :param apply: Callable taking a SolrConnection and returning True
+                      if Solr accepted every request made
+        :param bounded: Whether to give up once self.backoff has no retries
+                        left, instead of holding the update
+        :return: Tuple of the outcome, ACCEPTED, REJECTED or UNAVAILABLE,
+                 and the reason of the last failure
+        """
+        delays = self.backoff.delays()
+        while True:
+            solr = self._solr()
+            try:
+                if apply(solr):
+                    self.breaker.success()
+                    return ACCEPTED, None
+            except SolrException, e:
+                log.error("Solr rejected update: %s" % e)
+                self.breaker.success()
+                return REJECTED, str(e)
+            except Exception, e:
+                # Retrying the same code on the same data would not help
+                log.exception("Unexpected exception")
+                return REJECTED, 'unexpected exception: %r' % e
+            if solr.lastStatus is None:
+                reason = 'no answer from Solr'
+            else:
+                reason = 'HTTP code %d' % solr.lastStatus
+                if 400 <= solr.lastStatus < 500:
+                    self.breaker.success()
+                    return REJECTED, reason
+            self.breaker.failure()
+            if self.stopping:
+                return UNAVAILABLE, reason
+            try:
+                delay = delays.next()
+            except StopIteration:
+                if bounded:
+                    return UNAVAILABLE, reason
+                delay = self.backoff.max_delay
+            log.warning("Solr failed to apply update (%s), retrying in %.1fs"
+                        % (reason, delay))
+            metrics.incr('update.retries')
+            self.retry_wakeup.wait(delay)
+            self.breaker.wait(lambda: self.stopping)
+
+    def _dead_letter(self, msgs, reason):
+        """Spool messages that cannot be applied.
+
+        Writing the spool is retried with the delays of _retrying until it
+        works, rather than handing the messages back to the broker, which
+        would deliver them again right away.
+
+        :return: False if the messages could not be spooled before
+                 shutting down
+        """
+        if self.dead_letters is None:
+            log.error("Dropping %d message(s), no dead letter file is set: %s"
+                      % (len(msgs), reason))
+            metrics.incr('update.dropped', len(msgs))
+            return True
+        delays = self.backoff.delays()
+        while True:
+            try:
+                self.dead_letters.append([(msg.body, msg.properties)
+                                          for msg in msgs], reason)
+                break
+            except (IOError, OSError):
+                log.exception("Unable to spool %d message(s)" % len(msgs))
+            if self.stopping:
+                return False
+            try:
+                delay = delays.next()
+            except StopIteration:
+                delay = self.backoff.max_delay
+            metrics.incr('update.dead_letter_retries')
+            self.retry_wakeup.wait(delay)
+        log.error("Spooled %d message(s) to '%s': %s"
+                  % (len(msgs), self.dead_letters.path, reason))
+        metrics.incr('update.dead_letters', len(msgs))
+        return True
+
+    def _conclude(self, msgs, marks, outcome, reason):
+        """Settle messages once their update was sent to Solr.
 
-    @classmethod
-    def xml_field(cls, parent, name, value):
-        field = ET.SubElement(parent, 'field')
-        field.attrib['name'] = name
-        field.text = value
+        Messages Solr accepted are recorded in the status file and
+        acknowledged. Messages Solr rejected are spooled (see _dead_letter)
+        and acknowledged. Messages Solr could not apply are requeued.
+
+        :param marks: Results of _mark for the messages
+        :param outcome: Outcome of _retrying
+        """
+        ok = True
+        if outcome == ACCEPTED:
+            self._confirm(marks)
+        elif outcome == UNAVAILABLE:
+            log.error("Solr did not accept update, requeueing %d message(s)"
+                      % len(msgs))
+            metrics.incr('update.requeued', len(msgs))
+            ok = False
+        else:
+            metrics.incr('update.failed', len(msgs))
+            ok = self._dead_letter(msgs, reason)
+            if ok:
+                # Spooled messages no longer hold back their page
+                self._confirm(marks)
+        self._settle(msgs, ok)
+
+    def _apply_message(self, msg):
+        """Decode a message and apply it to Solr on its own.
+
+        """
+        try:
+            updates = self._decode(msg)
+        except Exception:
+            log.exception("Malformed update request")
+            self._conclude([msg], [self._mark({}, msg)], REJECTED,
+                           'malformed message')
+            return
+        outcome, reason = self._retrying(
+            lambda solr: self._apply(solr, updates))
+        self._conclude([msg], [self._mark(updates, msg)], outcome, reason)
 
     def _send_update(self, *args, **kwargs):
         """Send an update request to Solr.
 
-        Solr commits are made only on deletion.
+        Solr commits are made on deletion, or by the commit scheduler.
 
         Takes a single argument: the AMQP message that was received.
         """
+        log.info('Processing update request')
+        self._apply_message(args[0])
+
+    def _page(self, msg):
+        """Page of its database a message is part of, from its headers.
+
+        :return: Tuple of database name, sequence id, index of the message
+                 in the page and number of messages of the page, or None
+                 for messages that do not tell
+        """
+        headers = getattr(msg, 'properties', {}).get('application_headers')
+        try:
+            return (headers['db'], headers['seq'], headers['chunk'],
+                    headers['chunks'])
+        except (TypeError, KeyError):
+            return None
+
+    def _track(self, msg):
+        """Note the page of a message received.
+
+        Called from the consuming thread, so that pages are tracked in the
+        order they were announced, before any worker gets to them.
+
+        A page is tracked from the first of its messages received, as
+        messages of a page arrive in order and those before it were
+        settled before the updater started. At most MAX_PAGES pages are
+        tracked per database: past that, the oldest is given up on.
+        """
+        if self.status is None:
+            return
+        page = self._page(msg)
+        if page is None:
+            return
+        db_name, seq, chunk, chunks = page
+        self.status_lock.acquire()
         try:
-            log.info('Processing update request')
-            msg = args[0]
-            updates = json.loads(msg.body)
-            solr = SolrConnection(self.solr_uri)
-            if updates['type'] == 'updated':
-                add = ET.Element('add')
-                for update in updates['data']:
-                    doc = ET.SubElement(add, 'doc')
-                    for fields in update:
-                        # There should only be one pair
-                        # FIXME: move to a dictionary structure
-                        for k, v in fields.items():
-                            SolrUpdater.xml_field(doc, solr.escapeKey(k),
-                                                  solr.escapeVal(v))
-                log.debug("Sending update to Solr: " + ET.tostring(add))
-                solr.doUpdateXML(ET.tostring(add))
-            elif updates['type'] == 'deleted':
-                for id in updates['data']:
-                    log.debug("Deleting document with id '%s'" % id)
-                    solr.delete(id)
-                solr.commit()
-            elif updates['type'] == 'deleted_db':
-                db_name = updates['data']
-                log.info("Deleting indexes for database '%s'" % db_name)
-                solr.deleteByQuery("_db:%s" % db_name)
-                solr.commit()
+            last = self.status.get(db_name)
+            if last is not None and seq <= last['seq']:
+                # Redelivered after its page was recorded
+                return
+            pages = self.pages.setdefault(db_name, {})
+            if pages.has_key(seq):
+                return
+            pages[seq] = [set(xrange(chunk, chunks)), None]
+            if len(pages) > MAX_PAGES:
+                oldest = min(pages)
+                log.warning("Tracking more than %d pages of '%s', giving "
+                            "up on sequence id %s" % (MAX_PAGES, db_name,
+                                                      oldest))
+                pages[oldest][0].clear()
+                self._advance(db_name, time.time())
+        finally:
+            self.status_lock.release()
+
+    def _mark(self, updates, msg):
+        """Where in its database a message leaves off.
+
+        :return: Tuple of database name, sequence id, announce time and
+                 index of the message in its page, or None for messages
+                 that do not tell. The index is None for messages of
+                 announcers that do not send it.
+        """
+        page = self._page(msg)
+        if page is not None:
+            return page[0], page[1], updates.get('ts'), page[2]
+        if updates.has_key('db') and updates.has_key('seq'):
+            return updates['db'], updates['seq'], updates.get('ts'), None
+
+    def _confirm(self, marks):
+        """Record in the status file that Solr accepted messages.
+
+        A sequence id is recorded once every message of its page and of
+        the pages tracked before it (see _track) was settled, as messages
+        may be settled out of order. Messages spooled as rejected count as
+        settled, so they do not hold back the status for good.
+
+        :param marks: Results of _mark for the messages
+        """
+        if self.status is None:
+            return
+        now = time.time()
+        self.status_lock.acquire()
+        try:
+            for mark in marks:
+                if mark is None:
+                    continue
+                db_name, seq, ts, chunk = mark
+                if chunk is None:
+                    self._record(db_name, seq, ts, now)
+                    continue
+                page = self.pages.get(db_name, {}).get(seq)
+                if page is None:
+                    continue
+                page[0].discard(chunk)
+                if ts is not None:
+                    page[1] = ts
+                self._advance(db_name, now)
+        finally:
+            self.status_lock.release()
+
+    def _advance(self, db_name, now):
+        """Record the last of the oldest pages of a database that are
+        settled, and stop tracking them.
+
+        Must be called with status_lock held.
+        """
+        pages = self.pages[db_name]
+        done = None
+        for seq in sorted(pages):
+            remaining, ts = pages[seq]
+            if remaining:
+                break
+            del pages[seq]
+            done = seq, ts
+        if done is not None:
+            self._record(db_name, done[0], done[1], now)
+
+    def _record(self, db_name, seq, ts, now):
+        """Write a sequence id Solr caught up with to the status file.
+
+        Must be called with status_lock held.
+        """
+        last = self.status.get(db_name)
+        if last is None or seq > last['seq']:
+            self.status.set(db_name, {'seq' : seq, 'ts' : ts,
+                                      'confirmed' : now}, flush=False)
+
+    def __write_status(self):
+        log.info("Started thread to write status file")
+        while True:
+            time.sleep(1)
+            try:
+                self.status.flush()
+            except Exception:
+                log.exception("Unable to write status file")
+
+    def _decode(self, msg):
+        start = time.time()
+        updates = decode(msg.body, msg.properties.get('content_type'),
+                         msg.properties.get('content_encoding'))
+        metrics.observe('update.decode', time.time() - start)
+        return updates
+
+    def _settle(self, msgs, ok):
+        """Have messages acknowledged, or handed back to the broker.
+
+        Safe to call from any thread: the consuming thread does it, see
+        _settle_pending.
+        """
+        for msg in msgs:
+            self.settled.put((msg.delivery_info['delivery_tag'], ok))
+        try:
+            os.write(self.wake_write, 'x')
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _settle_pending(self):
+        """Acknowledge or requeue settled messages. Consuming thread only.
+
+        """
+        while True:
+            try:
+                tag, ok = self.settled.get_nowait()
+            except Queue.Empty:
+                return
+            if ok:
+                self.channel.basic_ack(tag)
             else:
-                log.warning("Unrecognized update type: '%s'" % updates['type'])
+                self.channel.basic_reject(tag, True)
+
+    def _buffered(self, transport):
+        """Whether amqplib already read data it has yet to dispatch.
+
+        """
+        if getattr(transport, '_read_buffer', None):
+            return True
+        sslobj = getattr(transport, 'sslobj', None)
+        if sslobj is not None and hasattr(sslobj, 'pending') \
+                and sslobj.pending():
+            return True
+        return not self.conn.method_reader.queue.empty() \
+            or bool(self.channel.method_queue)
+
+    def _wait(self, timeout):
+        """Dispatch a method from the broker, if one comes within timeout.
+
+        Also returns as soon as messages are settled. amqplib 0.8 cannot
+        time out a wait, and a timeout on its socket could cut a frame in
+        two, so this selects on the socket before waiting.
+        """
+        transport = getattr(self.conn, 'transport', None)
+        sock = getattr(transport, 'sock', None)
+        if sock is not None and not self._buffered(transport):
+            try:
+                readable = select.select([sock, self.wake_read], [], [],
+                                         timeout)[0]
+            except select.error, e:
+                # A signal interrupted the wait
+                if e.args[0] != errno.EINTR:
+                    raise
+                return
+            if self.wake_read in readable:
+                try:
+                    os.read(self.wake_read, 4096)
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+            if sock not in readable:
+                return
+        self.channel.wait()
+
+    def _flush(self, docs, msgs, marks, updates=None):
+        """Send buffered documents to Solr, then an optional other update.
+
+        msgs are the messages of it all, and marks their results of _mark.
+        They are settled together (see _conclude), but if Solr rejects
+        the update, each message is applied on its own, so that only those
+        Solr rejects are spooled.
+        """
+        try:
+            self._flush_buffer(docs, msgs, marks, updates)
+        finally:
+            self._flushed()
+
+    def _flush_buffer(self, docs, msgs, marks, updates):
+        log.info("Flushing %d buffered document(s)" % len(docs))
+        def apply(solr):
+            ok = True
+            if docs:
+                ok = self._add(solr, docs)
+            if ok and updates is not None:
+                ok = self._apply(solr, updates)
+            return ok
+        outcome, reason = self._retrying(apply)
+        if outcome == REJECTED and len(msgs) > 1:
+            log.warning("Solr rejected %d buffered message(s), applying "
+                        "them one at a time" % len(msgs))
+            for msg in msgs:
+                self._apply_message(msg)
+            return
+        self._conclude(msgs, marks, outcome, reason)
+
+    def _take_buffer(self):
+        """Empty the buffer. Must be called with buffer_lock held.
+
+        The flush of what it returns counts in flushes until _flush is done
+        with it, or _flushed is called.
+        """
+        self.flushes_cond.acquire()
+        try:
+            self.flushes += 1
+        finally:
+            self.flushes_cond.release()
+        docs, msgs, marks = self.buffer, self.buffer_msgs, self.buffer_marks
+        self.buffer, self.buffer_msgs, self.buffer_marks = [], [], []
+        self.buffer_started = None
+        return docs, msgs, marks
+
+    def _flushed(self):
+        self.flushes_cond.acquire()
+        try:
+            self.flushes -= 1
+            self.flushes_cond.notifyAll()
+        finally:
+            self.flushes_cond.release()
+
+    def _wait_flushes(self, count):
+        """Block until at most count flushes are not done.
+
+        """
+        start = time.time()
+        self.flushes_cond.acquire()
+        try:
+            while self.flushes > count:
+                self.flushes_cond.wait()
+        finally:
+            self.flushes_cond.release()
+        metrics.observe('update.flush_wait', time.time() - start)
+
+    def _buffer_message(self, msg):
+        """Add an update request to the buffer.
+
+        Documents of 'updated' messages are buffered until buffer_docs of
+        them are gathered. Any other message flushes the buffer and is
+        applied right after it, in the same worker, once the flushes
+        taken before are done, so that it does not overtake them.
+        """
+        try:
+            updates = self._decode(msg)
         except Exception:
-            log.exception("Unexpected exception")
+            log.exception("Malformed update request")
+            self._conclude([msg], [self._mark({}, msg)], REJECTED,
+                           'malformed message')
+            return
+
+        self.buffer_lock.acquire()
+        try:
+            if updates.get('type') == 'updated':
+                if self.buffer_started is None:
+                    self.buffer_started = time.time()
+                self.buffer.extend(updates['data'])
+                self.buffer_msgs.append(msg)
+                self.buffer_marks.append(self._mark(updates, msg))
+                if len(self.buffer) < self.buffer_docs:
+                    return
+                args = list(self._take_buffer())
+            else:
+                docs, msgs, marks = self._take_buffer()
+                args = [docs, msgs + [msg],
+                        marks + [self._mark(updates, msg)], updates]
+        finally:
+            self.buffer_lock.release()
+        if len(args) > 3:
+            # All but the flush just taken
+            self._wait_flushes(1)
+        self._submit(self._flush, *args)
+
+    def __flush_aged(self):
+        log.info("Started thread to flush buffered documents")
+        while not self.stopping:
+            self.flusher_wakeup.wait(self.buffer_age / 2.0)
+            args = None
+            self.buffer_lock.acquire()
+            try:
+                if self.buffer_started is not None and \
+                        time.time() - self.buffer_started >= self.buffer_age:
+                    args = list(self._take_buffer())
+            finally:
+                self.buffer_lock.release()
+            if args is not None:
+                self._submit(self._flush, *args)
+
+    def _submit(self, func, *args):
+        """Hand work to the workers, blocking while their queue is full.
+
+        Blocking the thread that reads from AMQP stops consumption until
+        Solr catches up, instead of piling up messages in memory.
+        """
+        metrics.observe('update.queue_wait', self.pool.submit(func, *args))
+
+    def _wait_for_solr(self):
+        """Pause consumption while Solr looks down (see CircuitBreaker).
+
+        """
+        if not self.breaker.is_open():
+            return
+        log.warning("Solr looks down, pausing consumption")
+        self._settle_pending()
+        metrics.incr('update.paused')
+        waited = self.breaker.wait(lambda: self.stopping)
+        metrics.observe('update.pause', waited)
 
     def _on_receive(self, msg):
         """Called when an update request is retrieved from AMQP queue."""
         log.debug("Received update request")
-        req = threadpool.WorkRequest(self._send_update, args=[msg])
-        self.pool.putRequest(req)
+        metrics.incr('amqp.consumed')
+        metrics.incr('amqp.consumed_bytes', len(msg.body))
+        self._track(msg)
+        self._wait_for_solr()
+        if self.buffer_docs > 0:
+            self._buffer_message(msg)
+            return
+        self._submit(self._send_update, msg)
 
-    def process_updates(self, workers=10):
+    def process_updates(self, workers=10, queue_size=0):
         """Main eval loop.
 
+        Runs until stop is called, then shuts down (see shutdown).
+
+        :param workers: Threads sending updates to Solr
+        :param queue_size: Max messages waiting for a worker before
+                           consumption from AMQP pauses, 0 for twice the
+                           number of workers
         """
-        self.workers = workers
-        self.pool = threadpool.ThreadPool(self.workers)
-        req = threadpool.WorkRequest(self.__poll_workers)
-        self.pool.putRequest(req)
+        self._start_workers(workers, queue_size)
+        if self.dead_letters is None:
+            log.warning("No dead letter file is set, updates Solr rejects "
+                        "will be dropped")
+        if self.commits is not None:
+            self.commits.start()
+        if self.status is not None:
+            writer = threading.Thread(target=self.__write_status)
+            writer.setDaemon(True)
+            writer.start()
         self.channel.basic_consume(self.amqp['queue'],
                                    callback=self._on_receive,
-                                   no_ack=True)
+                                   no_ack=False)
         log.info("Waiting for updates")
-        while True:
-            self.channel.wait()
+        while not self.stopping:
+            try:
+                self._wait(1.0)
+            except socket.error, e:
+                # A signal interrupted the wait
+                if e.args[0] != errno.EINTR:
+                    raise
+            self._settle_pending()
+        self.shutdown()
 
-    def __poll_workers(self):
-        log.info("Started thread to poll workers")
-        while True:
+    def _start_workers(self, workers, queue_size):
+        """Start what applies received messages.
+
+        """
+        self.workers = workers
+        self.pool = BoundedExecutor(workers, queue_size)
+        self.pool.start()
+        metrics.gauge('update.buffered_docs', lambda: len(self.buffer))
+        metrics.gauge('update.pending', self.pool.pending)
+        metrics.gauge('update.solr_down', lambda: int(self.breaker.is_open()))
+        if self.buffer_docs > 0:
+            self.flusher = threading.Thread(target=self.__flush_aged)
+            self.flusher.setDaemon(True)
+            self.flusher.start()
+
+    def _drain(self):
+        """Apply every message received so far.
+
+        """
+        if self.flusher is not None:
+            self.flusher_wakeup.set()
+            self.flusher.join()
+        if self.pool is not None:
+            self.buffer_lock.acquire()
             try:
-                self.pool.poll()
-            except threadpool.NoResultsPending:
-                pass
-            time.sleep(self.sleep_time)
+                args = list(self._take_buffer())
+            finally:
+                self.buffer_lock.release()
+            if args[1]:
+                self._submit(self._flush, *args)
+            else:
+                self._flushed()
+            self.pool.shutdown()
+
+    def stop(self):
+        """Have process_updates stop consuming and shut down.
+
+        Safe to call from a signal handler.
+        """
+        self.stopping = True
 
     def start_amqp(self):
         try:
@@ -121,10 +796,68 @@ class SolrUpdater(object):
             self.channel.exchange_declare(self.amqp['routing_key'], 'fanout')
             self.channel.queue_declare(self.amqp['queue'])
             self.channel.queue_bind(self.amqp['queue'], self.amqp['routing_key'])
+            if self.prefetch > 0:
+                self.channel.basic_qos(0, self.prefetch, False)
         except socket.error:
             return False
         return True
 
     def shutdown(self):
-        self.channel.close()
-        self.conn.close()
+        """Apply what was received, then close the connection.
+
+        What was received is applied first (see _drain), then pending
+        changes are committed and the status file written. Messages that
+        were not applied are requeued for the broker to deliver again.
+        """
+        log.info("Shutting down")
+        self.stopping = True
+        # Cut retries short: their messages go back to the broker
+        self.retry_wakeup.set()
+        self._drain()
+        self._settle_pending()
+        if self.commits is not None:
+            self.commits.stop()
+        if self.status is not None:
+            self.status.flush()
+        try:
+            self.channel.close()
+            self.conn.close()
+        except (socket.error, IOError):
+            log.exception("Problem closing connection to AMQP broker")
+        log.info("Shut down")
+
+    def replay(self):
+        """Apply the messages of the dead letter spool again.
+
+        Meant to run once Solr is back, or its schema fixed, whether the
+        updater is running or not. Messages that still fail stay in the
+        spool, including all those left once Solr looks down. The status
+        file is left to the running updater.
+
+        :return: Tuple of numbers of messages applied and kept
+        """
+        def apply(body, properties):
+            if self.breaker.is_open():
+                return 'Solr looks down'
+            try:
+                updates = decode(body, properties.get('content_type'),
+                                 properties.get('content_encoding'))
+            except Exception:
+                log.exception("Malformed update request")
+                return 'malformed message'
+            outcome, reason = self._retrying(
+                lambda solr: self._apply(solr, updates), bounded=True)
+            if outcome == ACCEPTED:
+                return None
+            return reason
+
+        if self.dead_letters is None:
+            return 0, 0
+        if self.commits is not None:
+            self.commits.start()
+        try:
+            applied, kept = self.dead_letters.replay(apply)
+        finally:
+            if self.commits is not None:
+                self.commits.stop()
+        return applied, kept
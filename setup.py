@@ -26,13 +26,14 @@ CouchDB.""",
     author='Jacinto Ximénez de Guzmán',
     author_email='x.de.guzman.j@gmail.com',
     license='MIT',
-    install_requires=['amqplib', 'httplib2', 'threadpool >= 1.2.4'],
+    install_requires=['amqplib'],
     packages=['couchdbsolr2'],
     entry_points={
         'console_scripts' : [
             'couchdb-solr2-index = couchdbsolr2.index:main',
             'couchdb-solr2-update = couchdbsolr2.update:main',
             'couchdb-solr2-query = couchdbsolr2.query:main',
+            'couchdb-solr2-status = couchdbsolr2.status:main',
         ]
     },
     classifiers = [
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2008 Jacinto Ximénez de Guzmán
+#
+# Code licensed under the MIT License. See COPYING or
+# http://www.opensource.org/licenses/mit-license.php
+# for details.
+
+"""The iterative flattener must give what the recursive one it replaced
+gave, in the same order.
+
+"""
+
+import os, random, sys, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from couchdbsolr2.flatten import flatten
+
+FIELDS = [u'field%d' % f for f in xrange(6)] + [u'', u'missing']
+
+
+def recursive(doc, fields):
+    """UpdateAnnouncer.__normalize and friends, as they were."""
+    def normalize(updates, path, obj):
+        if obj is None:
+            pass
+        elif isinstance(obj, str) or isinstance(obj, int) or isinstance(obj, float) or isinstance(obj, long) or isinstance(obj, unicode):
+            updates.append({path : obj})
+        elif isinstance(obj, list):
+            normalize_list(updates, path, obj)
+        elif isinstance(obj, dict):
+            normalize_dict(updates, path, obj)
+
+    def normalize_list(updates, path, obj):
+        for i, elem in enumerate(obj):
+            if path:
+                ext_path = "%s/$%d" % (path, i)
+            else:
+                ext_path = "$%d" % i
+            normalize(updates, ext_path, elem)
+
+    def normalize_dict(updates, path, obj):
+        for field in obj.keys():
+            if path:
+                ext_path = "%s/%s" % (path, field)
+            else:
+                ext_path = field
+            normalize(updates, ext_path, obj[field])
+
+    updates = []
+    for field in fields:
+        if doc.has_key(field):
+            normalize(updates, field, doc[field])
+    return updates
+
+
+def make_value(rand, depth):
+    kind = rand.random()
+    if depth > 3 or kind < 0.6:
+        return rand.choice([u'text %d' % rand.randint(0, 1000),
+                            rand.randint(0, 10 ** 6), rand.random() * 100,
+                            True, None, 10 ** 20])
+    elif kind < 0.8:
+        return [make_value(rand, depth + 1)
+                for i in xrange(rand.randint(0, 12 // (depth + 1)))]
+    return dict((u'key%d' % i, make_value(rand, depth + 1))
+                for i in xrange(rand.randint(0, 6)))
+
+
+def make_docs(count):
+    rand = random.Random(42)
+    docs = []
+    for i in xrange(count):
+        doc = dict((u'field%d' % f, make_value(rand, 0)) for f in xrange(6))
+        doc[u''] = [u'empty field name', {u'a' : [1, 2]}]
+        docs.append(doc)
+    return docs
+
+
+class FlattenTest(unittest.TestCase):
+
+    def test_same_as_recursive(self):
+        for doc in make_docs(500):
+            expected = [field.items()[0] for field in recursive(doc, FIELDS)]
+            self.assertEqual(flatten(doc, FIELDS), expected)
+
+    def test_paths(self):
+        doc = {u'a' : {u'b' : [1, None, u'x']}, u'c' : 2.5, u'd' : None}
+        self.assertEqual(flatten(doc, [u'a', u'c', u'd', u'e']),
+                         [(u'a/b/$0', 1), (u'a/b/$2', u'x'), (u'c', 2.5)])
+
+
+if __name__ == '__main__':
+    unittest.main()